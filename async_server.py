@@ -0,0 +1,177 @@
+import asyncio
+import time
+import signal
+import threading
+
+from message import *
+from server import ChatServer, Channel
+from server_log import DEBUG, WARNING
+
+
+class AsyncChatServer(ChatServer):
+    """Сервер на asyncio: все клиенты обслуживаются одним потоком с циклом событий.
+    Логика обработки сообщений общая с ChatServer, отличается только ввод-вывод"""
+
+    def start(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        if self.coalesce_window:
+            self.coalescer = AsyncCoalescer(self.loop, self.coalesce_window, self.coalesce_bytes)
+        self.loop.add_signal_handler(signal.SIGINT, self.shutdown)
+        if self.console:
+            threading.Thread(target=self.exec_commands, daemon=True).start()
+
+        self.server.setblocking(False)
+        server = await asyncio.start_server(self.handle_connection, sock=self.server)
+        async with server:
+            await self.stopping.wait()
+
+            self.log("Shutting down server...")
+            self.disconnect_all()
+            # Даём транспортам дописать srv_shutdown перед закрытием
+            closing = [asyncio.ensure_future(user.writer.wait_closed()) for user in self.users.snapshot()]
+            if closing:
+                await asyncio.wait(closing, timeout=self.queue_timeout + 1)
+        self.logger.close()
+
+    def shutdown(self, signum=None, frame=None):
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def handle_connection(self, stream_reader, stream_writer):
+        self.log(f"Accepted connection from {stream_writer.get_extra_info('peername')}")
+        self.socket_options.apply(stream_writer.get_extra_info('socket'))
+        reader = AsyncFrameReader(stream_reader, limits=self.frame_limits, heartbeat=self.new_heartbeat())
+        writer = AsyncFrameWriter(stream_writer, self.coalescer, self.queue_bytes,
+                                  self.queue_policy, self.queue_timeout)
+        self.attach_metrics(reader, writer)
+        try:
+            username = await self.set_username_async(reader, writer)
+        except OSError as e:
+            self.log(f'Login failed: {e}')
+            username = None
+        except Exception as e:
+            # Неизвестный тип кадра или имя не в UTF-8: соединение всё равно нужно закрыть
+            self.log(f'Malformed login: {e!r}', level=WARNING)
+            username = None
+        if username is None:
+            self.log('New user not added')
+            writer.close()
+            return
+        if isinstance(username, Channel):
+            await self.serve_channel_async(username)
+            return
+
+        self.login_done(reader)
+        user = self.add_user(username, writer.sock, reader, writer)
+
+        while True:
+            try:
+                msg_type, message = await user.reader.receive_message()
+                self.log(f'Received message "{message}" ({msg_type.name}) from {user}',
+                         level=DEBUG, limited=True)
+                if not await self.handle_transfer_async(user, msg_type, message):
+                    self.handle_message(user, msg_type, message)
+                # Уже прочитанные данные не отдают управление циклу, а рассылку
+                # должны успеть разобрать задачи-писатели, иначе их очереди переполнятся
+                await asyncio.sleep(0)
+            except Exception as e:
+                if not self.handle_error(user, e):
+                    break
+
+    async def handle_transfer_async(self, user, msg_type, message):
+        if msg_type == MsgType.put_file:
+            await self.receive_file_async(user, message)
+        elif msg_type == MsgType.get_file:
+            self.send_filelist(user)
+            _, request = await user.reader.receive_message()
+            if not request:
+                self.log('Stopped file sending procedure')
+            else:
+                await self.send_file_async(user, request)
+        else:
+            return False
+        return True
+
+    async def serve_channel_async(self, channel):
+        while True:
+            try:
+                msg_type, message = await channel.reader.receive_message()
+                if not await self.handle_transfer_async(channel, msg_type, message):
+                    raise TransferError(f'Unexpected message of type {msg_type.name}')
+            except Exception as e:
+                self.close_channel(channel, e)
+                break
+
+    async def set_username_async(self, reader, writer):
+        """Имя вошедшего пользователя, Channel для канала передачи файлов или None"""
+        while True:
+            try:
+                t, username = await reader.receive_message(throw_empty=False)
+            except FrameTooLarge as e:
+                writer.send_message(str(e), MsgType.error)
+                continue
+            if t == MsgType.hello:
+                self.accept_features(reader, writer, username.split())
+                continue
+            if t == MsgType.channel:
+                return self.open_channel(username, reader, writer)
+            if t == MsgType.empty or not username:
+                return None
+            reply = self.username_reply(username)
+            writer.send_message(reply)
+            if reply == '0':
+                return username
+
+    async def receive_file_async(self, user, request):
+        # Недокачанное начало файла перечитывается для подсчёта хеша, поэтому не в цикле событий
+        try:
+            filename, upload, expected = await asyncio.to_thread(self.start_upload, user, request)
+        except (OSError, ValueError) as e:
+            self.reject_upload(user, e)
+            return
+        if upload is None:
+            self.finish_upload(user, filename, digest=expected[2])
+            return
+        started = time.monotonic()
+        try:
+            with upload:
+                size = 0
+                if expected is None or expected[0] < expected[1]:
+                    size = await read_file_stream(user.reader, upload, on_range=self.range_check(upload, expected))
+            self.check_upload(upload, expected)
+        except (TransferError, FrameTooLarge, OSError, ValueError, Empty) as e:
+            self.discard_upload(user, upload, e)
+        else:
+            self.count_transfer('in', size, started)
+            self.finish_upload(user, filename, upload)
+
+    async def send_file_async(self, user, request):
+        fileid, *file_range = request.split()
+        f, digest = self.open_stored_file(user, fileid)
+        if f is None:
+            return
+        started = time.monotonic()
+        if file_range or FEATURE_RAW_FILES in user.writer.features:
+            try:
+                # Контрольная сумма части или первый подсчёт для всего файла читают его с диска,
+                # поэтому не в цикле событий
+                transfer = await asyncio.to_thread(self.file_range, f, digest, file_range or (0, 0))
+            except (IOError, ValueError) as e:
+                f.close()
+                self.log(f'Error sending file #{fileid}: {e}', level=WARNING)
+                user.writer.send_byte_message(b'', MsgType.error)
+                return
+            self.send_file_raw(user, fileid, f, digest, transfer, bool(file_range), started)
+            return
+        with f:
+            try:
+                await write_file_stream(user.writer, f)
+            except IOError as e:
+                self.log(f'Error sending file #{fileid}: {e}', level=WARNING)
+                user.writer.send_byte_message(b'', MsgType.error)
+                return
+            self.count_transfer('out', f.tell(), started)
+        self.log(f'Sent file #{fileid} to "{user}"')
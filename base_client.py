@@ -1,3 +1,5 @@
+import argparse
+import re
 import socket
 import threading
 import queue
@@ -8,7 +10,19 @@ import os
 
 from message import *
 
+UPLOAD_REPLY_TIMEOUT = 30  # Сколько ждать ответа сервера на запрос докачиваемой загрузки
+# Возможности, которые имеют смысл для канала передачи файлов
+CHANNEL_FEATURES = (FEATURE_CODECS, FEATURE_FIELDS, FEATURE_ZSTREAM, FEATURE_RAW_FILES, FEATURE_RESUME)
+
 class BaseChatClient:
+    features = (FEATURE_CODECS, FEATURE_FIELDS, FEATURE_ZSTREAM, FEATURE_BATCH, FEATURE_PING, FEATURE_RAW_FILES,
+                FEATURE_RESUME, FEATURE_CHANNEL)
+    socket_options = SocketOptions()
+    # Сервер, молчащий idle_timeout секунд, получает ping; без ответа за read_timeout соединение
+    # считается оборванным. 0 отключает проверку
+    idle_timeout = 20
+    read_timeout = 10
+
     def __init__(self, host, port):
         self.host = host
         self.port = port
@@ -18,6 +32,11 @@ class BaseChatClient:
         signal.signal(signal.SIGTERM, self.terminate)
         
         self.queue = queue.Queue()
+        self.send_lock = threading.RLock()
+        self.history_cursor = ''  # Пустой курсор: сообщения старше полученных при входе
+        self.file_range = None    # (смещение, длина) для скачивания части файла
+        self.upload_replies = queue.Queue()  # Смещения, с которых сервер ждёт загружаемые файлы
+        self.channel_token = None  # Выдаётся сервером с FEATURE_CHANNEL для открытия каналов передачи
         
         # signal.signal(signal.SIGINT, self.terminate)
     
@@ -31,19 +50,24 @@ class BaseChatClient:
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             #self.sock.settimeout(3)
+            self.socket_options.apply(self.sock)
             self.sock.connect((host, port))
+            heartbeat = Heartbeat(self.idle_timeout, self.read_timeout) if self.idle_timeout else None
+            self.reader = FrameReader(self.sock, heartbeat=heartbeat)
+            self.writer = FrameWriter(self.sock)
             self.opened = True
         except Exception as e:
             self.abort(f'Cannot connect to the server: {e}')
 
     def login(self):
+        self.negotiate_features()
         self.askusername()
         while True:
             if not self.username:
                 self.send_message(self.username)
                 self.quit()
             self.send_message(self.username)
-            t, ok = receive_message(self.sock, throw_empty=False)
+            t, ok = self.receive_reply()
             if t == MsgType.empty:
                 self.abort('Cannot connect to the server')
             if ok == "0":
@@ -54,6 +78,25 @@ class BaseChatClient:
                 self.askusername(is_not_valid = True)
             else:
                 self.abort('Unexpected message received')
+        if self.reader.writer is None:
+            # Старый сервер не отвечает на ping, ждать от него сообщений можно сколько угодно
+            self.reader.set_heartbeat(None)
+
+    def receive_reply(self):
+        """Ответ сервера при входе; оборванное или молчащее соединение даёт MsgType.empty"""
+        try:
+            return self.reader.receive_message(throw_empty=False)
+        except OSError:
+            return MsgType.empty, ''
+
+    def negotiate_features(self):
+        if not self.features:
+            return
+        self.send_message(' '.join(self.features), MsgType.hello)
+        t, accepted = self.receive_reply()
+        if t != MsgType.hello:
+            self.abort('Cannot connect to the server')
+        apply_features(self.reader, self.writer, accepted.split())
 
     def __del__(self):
         self.close_connection()
@@ -71,28 +114,37 @@ class BaseChatClient:
     def receiving_loop(self):
         while True:
             try:
-                msg_type, message = receive_message(self.sock)
-                self.handle_message(msg_type, message)
+                msg_type, data = self.reader.receive_byte_message()
+                self.handle_message(msg_type, data)
             
             except self.StopReceiving:
                 break
+
+            except FrameTooLarge as e:
+                self.display_error(f'Rejected message from the server: {e}')
                 
             except Empty:
                 if self.opened:
                     self.abort('Connection lost')
                 break
 
+            except TimeoutError:
+                if self.opened:
+                    self.abort('Server is not responding')
+                break
+
             except Exception as e:
                 self.abort(f'Error receiving messages: {e}')
                 break
 
-    def handle_message(self, msg_type, message):
+    def handle_message(self, msg_type, data):
         if msg_type == MsgType.chatmsg:
-            self.display_message(*message.split('\0'))
+            user, message = self.decode_fields(data)
+            self.display_message(user, message)
         elif msg_type == MsgType.special:
-            self.display_special_message(message)
+            self.display_special_message(data.decode())
         elif msg_type == MsgType.error:
-            self.display_error(message)
+            self.display_error(data.decode())
         elif msg_type == MsgType.srv_shutdown:
             self.abort('Server was shut down')
             raise self.StopReceiving
@@ -100,25 +152,42 @@ class BaseChatClient:
             self.abort('You are banned')
             raise self.StopReceiving
         elif msg_type == MsgType.usersinfo:
-            self.display_usersinfo(message.split('\0'))
+            self.display_usersinfo(self.decode_fields(data))
         elif msg_type == MsgType.get_file:
-            self.handle_file_transfer(message)
+            self.handle_file_transfer(data)
+        elif msg_type == MsgType.put_file:
+            self.upload_replies.put(data.decode())
+        elif msg_type == MsgType.channel:
+            self.channel_token = data.decode()
+        elif msg_type == MsgType.history:
+            self.history_cursor = data.decode()
+            if self.history_cursor == '0':
+                self.display_info('No older messages')
+        elif msg_type == MsgType.batch:
+            for inner_type, inner_data in iter_batch(data):
+                self.handle_message(inner_type, inner_data)
         else:
             raise self.InvalidMessageType('Received invalid message')
     
-    def handle_file_transfer(self, message):
-        if not message:
+    def decode_fields(self, data):
+        # Старый сервер разделяет поля NUL
+        return decode_fields(data, legacy=FEATURE_FIELDS not in self.writer.features)
+
+    def handle_file_transfer(self, data, channel=None):
+        """Выбор и скачивание файла из списка data; channel — TransferChannel или основное соединение"""
+        channel = channel or self
+        if not data:
                 self.display_info('Nothing to download')
-                self.send_message('')
+                channel.send_message('')
                 return
             
-        filelist = message.split('\0')
+        filelist = decode_fields(data, legacy=FEATURE_FIELDS not in channel.writer.features)
         fileids = filelist[::2]
         filenames = filelist[1::2]
 
         if len(fileids) != len(filenames):
             self.display_error('Invalid data received')
-            self.send_message('')
+            channel.send_message('')
             return
 
         #files = tuple(zip(fileids, filenames))
@@ -126,29 +195,120 @@ class BaseChatClient:
         index = self.select_file(filenames)
 
         if index == -1:
-            self.send_message('')
+            channel.send_message('')
             return
         
         fileid, filename = fileids[index], filenames[index]
 
-        self.send_message(fileid)
+        filename = self.save_file(default_name=filename)
         
-        t, data = receive_byte_message(self.sock)
+        if not filename:
+            channel.send_message('')
+            return
 
-        if t == MsgType.error:
-            self.display_error('File cannot be downloaded')
+        if FEATURE_RESUME in channel.writer.features:
+            file_range, self.file_range = self.file_range, None
+            if file_range is None:
+                self.download_resumable(fileid, filename, channel)
+                return
+            # Запрошенная часть сохраняется отдельным файлом, без докачки
+            channel.send_message(f'{fileid} {file_range[0]} {file_range[1]}')
+            self.receive_file_to(filename, channel)
             return
 
-        filename = self.save_file(default_name=filename)
-        
-        if not filename:
+        try:
+            f = open(filename, "wb")
+        except OSError:
+            self.display_error('Cannot save file')
+            channel.send_message('')
             return
 
+        channel.send_message(fileid)
+
+        timed_out = None
+        with f:
+            try:
+                receive_file_stream(channel.reader, f, on_other=channel.handle_message)
+                return
+            except TransferError:
+                self.display_error('File cannot be downloaded')
+            except TimeoutError as e:
+                # Сервер замолчал посреди файла, соединение закроет receiving_loop
+                timed_out = e
+            except OSError:
+                self.display_error('Cannot save file')
+        os.remove(filename)
+        if timed_out is not None:
+            raise timed_out
+
+    def receive_file_to(self, filename, channel):
+        files = []
+
+        def on_range(offset, total, digest):
+            files.append(open(filename, 'wb'))
+            return files[0]
+        try:
+            receive_file_stream(channel.reader, None, on_other=channel.handle_message, on_range=on_range)
+        except TransferError:
+            self.display_error('File cannot be downloaded')
+        except OSError as e:
+            if isinstance(e, TimeoutError):
+                raise
+            self.display_error('Cannot save file')
+        finally:
+            for f in files:
+                f.close()
+
+    def download_resumable(self, fileid, filename, channel):
+        """Файл принимается в <имя>.<хеш>.part и переименовывается после проверки. Если такой
+        файл остался от прерванного скачивания, сервер присылает только недостающий конец"""
+        partial, digest = find_partial(filename)
+        if partial is None:
+            channel.send_message(f'{fileid} 0 0')
+        else:
+            channel.send_message(f'{fileid} {os.path.getsize(partial)} 0 {digest}')
+        state = {}
+
+        def on_range(offset, total, digest):
+            path = f'{filename}.{digest}.part'
+            if partial is not None and partial != path:
+                # На сервере под этим id уже другое содержимое
+                os.remove(partial)
+            f = open(path, 'r+b' if offset else 'wb')
+            f.truncate(offset)
+            f.seek(offset)
+            state.update(f=f, path=path, digest=digest, offset=offset)
+            if offset:
+                self.display_info(f'Resuming download from {offset} of {total} bytes')
+            return f
+
         try:
-            with open(filename, "wb") as f:
-                f.write(data)
+            receive_file_stream(channel.reader, None, on_other=channel.handle_message, on_range=on_range)
+        except TransferError:
+            # Испорчен только последний кусок, но какой именно — неизвестно: начинаем заново
+            self.display_error('File cannot be downloaded')
+            self.remove_partial(state)
+            return
+        except (Empty, TimeoutError):
+            # Принятое остаётся в .part до следующей попытки
+            if 'f' in state:
+                state['f'].close()
+            raise
         except OSError:
             self.display_error('Cannot save file')
+            self.remove_partial(state)
+            return
+        with state['f'] as f:
+            if state['offset'] and file_digest(f)[0] != state['digest']:
+                self.display_error('File cannot be downloaded')
+                os.remove(state['path'])
+                return
+        os.replace(state['path'], filename)
+
+    def remove_partial(self, state):
+        if 'f' in state:
+            state['f'].close()
+            os.remove(state['path'])
 
     def display_message(self, user, message):
         raise NotImplementedError("This method should be overridden in subclasses")
@@ -164,16 +324,54 @@ class BaseChatClient:
 
     def send_message(self, message, msg_type = MsgType.none):
         try:
-            send_message(self.sock, message, msg_type)
+            with self.send_lock:
+                self.writer.send_message(message, msg_type)
         except Exception as e:
             self.abort(f'An error occured while sending messages {e}')
 
-    def download_file(self):
-        self.send_message("", MsgType.get_file)
+    def download_file(self, offset=0, length=0):
+        """Без аргументов — весь файл с докачкой; иначе только length байт с offset (0 — до конца)"""
+        self.file_range = (offset, length) if offset or length else None
+        if self.channel_token is None:
+            self.send_message("", MsgType.get_file)
+            return
+        threading.Thread(target=self.download_in_channel, daemon=True).start()
+
+    def download_in_channel(self):
+        channel = self.open_channel()
+        if channel is None:
+            self.send_message("", MsgType.get_file)
+            return
+        try:
+            with channel:
+                channel.send_message("", MsgType.get_file)
+                self.handle_file_transfer(channel.wait_reply(MsgType.get_file), channel)
+        except (OSError, Empty, TransferError) as e:
+            self.display_error(f'File transfer failed: {str(e) or "connection lost"}')
+
+    def open_channel(self):
+        """Отдельное соединение для передачи файла, None — передавать по основному"""
+        token = self.channel_token
+        if token is None:
+            return None
+        try:
+            channel = TransferChannel(self.host, self.port, self.features, token)
+        except (OSError, Empty, TransferError):
+            # Например, сервер перезапущен и токен устарел
+            self.channel_token = None
+            return None
+        return channel
 
     def get_usersinfo(self):
         self.send_message("", MsgType.usersinfo)
 
+    def request_history(self, count=50):
+        """Просит у сервера предыдущую страницу истории, она придёт обычными сообщениями"""
+        if self.history_cursor == '0':
+            self.display_info('No older messages')
+            return
+        self.send_message(f'{count} {self.history_cursor}'.strip(), MsgType.history)
+
     def display_usersinfo(self, users_online):
         answer = "Now online are: \n" + "\n".join(map(lambda s: f'"{s}"', users_online))
         self.display_info(answer)
@@ -187,16 +385,67 @@ class BaseChatClient:
         if not filename:
             return
 
+        channel = self.open_channel()
+        if channel is None:
+            self.send_file(filename, self)
+            return
+        try:
+            with channel:
+                self.send_file(filename, channel)
+                # Ошибки сервер присылает до того, как закроет канал
+                for text in channel.finish():
+                    self.display_error(text)
+        except (OSError, Empty, TransferError) as e:
+            self.display_error(f'File transfer failed: {str(e) or "connection lost"}')
+
+    def send_file(self, filename, channel):
         basename = os.path.basename(filename)
-        self.send_message(basename, MsgType.put_file)
+        if FEATURE_RESUME in channel.writer.features:
+            self.upload_resumable(filename, basename, channel)
+            return
+
+        # Кадры файла не должны перемешиваться с другими сообщениями
+        with channel.send_lock:
+            channel.send_message(basename, MsgType.put_file)
+
+            try:
+                with open(filename, "rb") as f:
+                    send_file_stream(channel.writer, f)
+            except OSError:
+                channel.send_message("", MsgType.error)
+        
 
+    def upload_resumable(self, filename, basename, channel):
+        """Сервер отвечает, сколько байт этого содержимого у него уже есть, и получает только остаток"""
         try:
-            with open(filename, "rb") as f:
-                data = f.read()
-                send_byte_message(self.sock, data)
+            f = open(filename, 'rb')
+            digest, size = file_digest(f)
         except OSError:
-            self.send_message("", MsgType.error)
-        
+            self.display_error('Cannot read file')
+            return
+        with f, channel.send_lock:
+            channel.send_message(f'{digest} {size} {basename}', MsgType.put_file)
+            offset = channel.wait_upload_offset()
+            if offset is None:
+                return
+            if offset >= size:
+                return
+            if offset:
+                self.display_info(f'Resuming upload from {offset} of {size} bytes')
+            start = lambda codec: FILE_START_RANGE.pack(codec, offset, size - offset, size, bytes.fromhex(digest))
+            try:
+                f.seek(offset)
+                send_file_stream(channel.writer, f, start)
+            except OSError:
+                channel.send_message("", MsgType.error)
+
+    def wait_upload_offset(self):
+        # Ответ на put_file читает receiving_loop
+        try:
+            return int(self.upload_replies.get(timeout=UPLOAD_REPLY_TIMEOUT))
+        except queue.Empty:
+            self.abort('Server did not answer the upload request')
+            return None
 
     def open_file(self):
         raise NotImplementedError("This method should be overridden in subclasses")
@@ -331,6 +580,96 @@ class ThreadSafeChatClient(BaseChatClient):
     
     
 
+class TransferChannel:
+    """Второе соединение с сервером (FEATURE_CHANNEL) для одной передачи файла: пока она идёт,
+    чат по основному соединению не ждёт. Вход подтверждается токеном, выданным при входе в чат"""
+
+    handle_message = None  # Посторонних кадров в канале не бывает
+
+    def __init__(self, host, port, features, token):
+        self.sock = socket.create_connection((host, port))
+        try:
+            BaseChatClient.socket_options.apply(self.sock)
+            # Сервер по каналу ping не шлёт, поэтому долгое молчание означает обрыв
+            heartbeat = Heartbeat(BaseChatClient.idle_timeout, BaseChatClient.read_timeout) \
+                if BaseChatClient.idle_timeout else None
+            self.reader = FrameReader(self.sock, heartbeat=heartbeat)
+            self.writer = FrameWriter(self.sock)
+            self.send_lock = threading.RLock()
+            offered = [feature for feature in features if feature in CHANNEL_FEATURES]
+            self.send_message(' '.join(offered), MsgType.hello)
+            apply_features(self.reader, self.writer, self.wait_reply(MsgType.hello).decode().split())
+            self.send_message(token, MsgType.channel)
+            self.wait_reply(MsgType.channel)
+        except BaseException:
+            self.sock.close()
+            raise
+
+    def send_message(self, message, msg_type=MsgType.none):
+        self.writer.send_message(message, msg_type)
+
+    def wait_reply(self, msg_type):
+        t, data = self.reader.receive_byte_message()
+        if t == MsgType.error:
+            raise TransferError(data.decode())
+        if t != msg_type:
+            raise TransferError(f'Unexpected message of type {t.name}')
+        return data
+
+    def wait_upload_offset(self):
+        return int(self.wait_reply(MsgType.put_file))
+
+    def finish(self):
+        """Закрывает передачу со своей стороны и возвращает ошибки, присланные сервером до закрытия"""
+        self.sock.shutdown(socket.SHUT_WR)
+        errors = []
+        while True:
+            try:
+                t, data = self.reader.receive_byte_message()
+            except Empty:
+                return errors
+            if t == MsgType.error and data:
+                errors.append(data.decode())
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def find_partial(filename):
+    """Недокачанный filename: (путь к .part, хеш содержимого) или (None, None)"""
+    directory, name = os.path.split(filename)
+    pattern = re.escape(name) + r'\.([0-9a-f]{64})\.part'
+    try:
+        names = os.listdir(directory or '.')
+    except OSError:
+        return None, None
+    for entry in names:
+        match = re.fullmatch(pattern, entry)
+        if match:
+            return os.path.join(directory, entry), match.group(1)
+    return None, None
+
+
+def parse_client_args(description='Chat client'):
+    """Адрес сервера и настройки сокета из командной строки, общие для всех клиентов"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--host', default='localhost', help='server address')
+    parser.add_argument('--port', type=int, default=5555, help='server port')
+    SocketOptions.add_arguments(parser)
+    Heartbeat.add_arguments(parser, BaseChatClient.idle_timeout, BaseChatClient.read_timeout)
+    args = parser.parse_args()
+    BaseChatClient.socket_options = SocketOptions.from_args(args)
+    BaseChatClient.idle_timeout = args.idle_timeout
+    BaseChatClient.read_timeout = args.read_timeout
+    return args
+
+
 def thread_safe(client_class):
     class Wrapper(client_class):
         @ThreadSafeChatClient.run_in_main_thread
@@ -2,7 +2,7 @@ import signal
 import os
 from colorama import init, Fore, Style
 
-from base_client import BaseChatClient
+from base_client import BaseChatClient, parse_client_args
 
 class CLIChatClient(BaseChatClient):
     def __init__(self, host='localhost', port=5555):
@@ -74,6 +74,14 @@ class CLIChatClient(BaseChatClient):
                     self.upload_file()
                 elif message == '/download':
                     self.download_file()
+                elif message.startswith('/download '):
+                    # /download offset [length] — только часть файла
+                    try:
+                        self.download_file(*map(int, message.split()[1:3]))
+                    except ValueError:
+                        self.display_error('Invalid command')
+                elif message == '/history':
+                    self.request_history()
                 else:
                     self.display_error('Invalid command')
             else:
@@ -81,4 +89,5 @@ class CLIChatClient(BaseChatClient):
         # self.quit()
 
 if __name__ == "__main__":
-    client = CLIChatClient()
+    args = parse_client_args('Console chat client')
+    client = CLIChatClient(args.host, args.port)
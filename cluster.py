@@ -0,0 +1,408 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+from multiprocessing.connection import Listener, Client
+
+from message import *
+from storage import HistoryStore, FileStore, format_entry
+
+
+# Несколько рабочих процессов слушают один порт через SO_REUSEPORT. Общее состояние
+# (занятые имена, список онлайн, номера файлов, порядок рассылок и запись истории) хранит
+# главный процесс, рабочие обмениваются с ним сообщениями по Unix-сокету:
+#   рабочий -> хаб: ('call', id, op, args) с ответом ('reply', id, result) или ('cast', op, args)
+#   хаб -> рабочие: ('broadcast', seq, msg_type, data), ('file_added', fileid, filename, digest),
+#                   ('file_removed', fileid), ('kill', name), ('sendto', name, text), ('log',), ('stats',),
+#                   ('users',)
+# Консоль хаба: send, sendto, users, kill, files, load, rm, log, stats, clear. Команды, которые
+# касаются соединений (sendto, users, kill) и журналов (log, stats), выполняют рабочие процессы
+
+
+class Hub:
+    """Главный процесс кластера: общий реестр имён и единый порядок рассылок"""
+
+    def __init__(self, history_db='./history.db', files_directory='./files'):
+        self.address = os.path.join(tempfile.mkdtemp(prefix='chat-'), 'bus')
+        self.authkey = os.urandom(16)
+        self.listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        self.lock = threading.Lock()
+        self.workers = {}   # Connection -> очередь отправки
+        self.reserved = {}  # имя -> Connection рабочего, который его занял
+        self.online = {}    # имя -> Connection, в порядке входа
+        self.channels = {}  # токен канала передачи файлов -> имя; канал может открыться в любом рабочем
+        # Рабочие сами кладут принятые файлы в общий каталог, а хаб ведёт индекс, счётчики
+        # ссылок и удаляет blob, на который больше не ссылается ни один id. Рабочие читают
+        # индекс только при запуске, дальше изменения приходят от хаба
+        self.file_store = FileStore(files_directory)
+        self.history_store = HistoryStore(history_db) if history_db else None
+        self.seq = 0
+        if self.history_store is not None:
+            last = self.history_store.page(limit=1)
+            self.seq = last[0][0] if last else 0
+        self.processes = []
+
+    def log(self, text):
+        print(text)
+
+    def start_workers(self, count, mode, options):
+        # spawn, чтобы рабочие не наследовали потоки и обработчики сигналов главного процесса
+        context = multiprocessing.get_context('spawn')
+        for index in range(count):
+            process = context.Process(target=run_worker,
+                                      args=(mode, options, self.address, self.authkey, index))
+            process.start()
+            self.processes.append(process)
+
+    def serve(self):
+        signal.signal(signal.SIGINT, self.shutdown)
+        threading.Thread(target=self.exec_commands, daemon=True).start()
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                continue
+            outbox = queue.Queue()
+            with self.lock:
+                self.workers[conn] = outbox
+            threading.Thread(target=self.handle_worker, args=(conn,), daemon=True).start()
+            threading.Thread(target=self.send_loop, args=(conn, outbox), daemon=True).start()
+
+    def send(self, conn, message):
+        # Отправка через очередь: хаб не ждёт рабочего, который сам ждёт хаб
+        outbox = self.workers.get(conn)
+        if outbox is not None:
+            outbox.put(message)
+
+    def send_loop(self, conn, outbox):
+        while True:
+            message = outbox.get()
+            if message is None:
+                return
+            try:
+                conn.send(message)
+            except OSError:
+                return
+
+    def send_all(self, message):
+        for conn in list(self.workers):
+            self.send(conn, message)
+
+    def handle_worker(self, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'call':
+                _, call_id, op, args = message
+                self.send(conn, ('reply', call_id, getattr(self, 'op_' + op)(conn, *args)))
+            else:
+                _, op, args = message
+                getattr(self, 'op_' + op)(conn, *args)
+        self.drop_worker(conn)
+
+    def drop_worker(self, conn):
+        """Рабочий завершился: его пользователи покидают чат"""
+        with self.lock:
+            self.workers.pop(conn).put(None)
+            left = [name for name, owner in self.online.items() if owner is conn]
+            for name, owner in list(self.reserved.items()):
+                if owner is conn:
+                    del self.reserved[name]
+                    self.online.pop(name, None)
+                    self.forget_channels(name)
+        for name in left:
+            self.publish(Frame.from_message(f"'{name}' has left the chat", MsgType.special))
+
+    def publish(self, frame):
+        # Номер выдаётся и кадр рассылается под одной блокировкой, чтобы порядок у всех был одинаков
+        with self.lock:
+            if self.history_store is not None:
+                self.seq = self.history_store.append(frame)
+            else:
+                self.seq += 1
+            self.send_all(('broadcast', self.seq, frame.msg_type.value, frame.data))
+
+    def op_reserve(self, conn, name):
+        with self.lock:
+            if name in self.reserved:
+                return False
+            self.reserved[name] = conn
+            return True
+
+    def op_release(self, conn, name):
+        with self.lock:
+            if self.reserved.get(name) is conn:
+                del self.reserved[name]
+                self.online.pop(name, None)
+                self.forget_channels(name)
+
+    def op_online(self, conn, name):
+        with self.lock:
+            self.online[name] = conn
+
+    op_offline = op_release
+
+    def op_channel_token(self, conn, token, name):
+        with self.lock:
+            self.channels[token] = name
+
+    def op_channel_owner(self, conn, token):
+        with self.lock:
+            return self.channels.get(token)
+
+    def forget_channels(self, name):
+        for token in [token for token, owner in self.channels.items() if owner == name]:
+            del self.channels[token]
+
+    def op_names(self, conn):
+        with self.lock:
+            return list(self.online)
+
+    def op_fileid(self, conn):
+        return self.file_store.new_id()
+
+    def op_commit_file(self, conn, fileid, filename, path, digest, uploader, checksum):
+        """Добавляет принятый рабочим файл (без path — новую ссылку на хранящийся blob).
+        Есть ли уже такой blob, решается здесь, под той же блокировкой, что и удаление файлов:
+        иначе rm последней ссылки мог удалить blob, который рабочий счёл дубликатом.
+        Возвращает, хранилось ли уже такое содержимое, или None, если blob успели удалить"""
+        with self.lock:
+            if path is not None:
+                duplicate = self.file_store.store(path, digest, checksum, fileid, filename, uploader)
+            elif self.file_store.link(digest, fileid, filename, uploader):
+                duplicate = True
+            else:
+                return None
+            self.send_all(('file_added', fileid, filename, digest))
+        return duplicate
+
+    def load_file(self, filename):
+        """Команда load: файл администратора добавляется так же, как принятый рабочим"""
+        upload = self.file_store.upload()
+        try:
+            with open(filename, 'rb') as src, upload:
+                shutil.copyfileobj(src, upload)
+        except OSError:
+            self.file_store.discard(upload)
+            raise
+        fileid = self.file_store.new_id()
+        name = os.path.basename(filename)
+        with self.lock:
+            digest, _ = self.file_store.commit(upload, fileid, name, 'admin')
+            self.send_all(('file_added', fileid, name, digest))
+
+    def op_broadcast(self, conn, msg_type, data):
+        self.publish(Frame(data, MsgType(msg_type)))
+
+    def remove_file(self, fileid):
+        with self.lock:
+            filename = self.file_store.remove(fileid)
+            if filename is not None:
+                self.send_all(('file_removed', fileid))
+        return filename
+
+    def exec_commands(self):
+        while True:
+            try:
+                cmd = input('>>').strip()
+                if not cmd:
+                    continue
+                cmd, *args = re.split(r'\s+', cmd)
+
+                if cmd == 'send':
+                    text = input('Message: ')
+                    self.publish(Frame(encode_fields('admin', text), MsgType.chatmsg))
+
+                elif cmd == 'sendto' and args:
+                    with self.lock:
+                        conn = self.online.get(args[0])
+                    if conn is None:
+                        print(f'User {args[0]} does not exist')
+                    else:
+                        self.send(conn, ('sendto', args[0], input('Message: ')))
+
+                elif cmd == 'users':
+                    # Очереди и задержки отправки известны только рабочим
+                    with self.lock:
+                        self.send_all(('users',))
+
+                elif cmd == 'kill' and args:
+                    with self.lock:
+                        conn = self.online.get(args[0])
+                    if conn is None:
+                        print(f'User {args[0]} does not exist')
+                    else:
+                        self.send(conn, ('kill', args[0]))
+
+                elif cmd == 'files':
+                    for entry in self.file_store.entries():
+                        print(format_entry(entry))
+
+                elif cmd == 'load':
+                    filename = input('Enter filename: ')
+                    self.load_file(filename)
+                    self.publish(Frame.from_message(f'admin sent file "{filename}"', MsgType.special))
+
+                elif cmd == 'log':
+                    # Журналы ведут рабочие, у хаба только консоль
+                    with self.lock:
+                        self.send_all(('log',))
+
+                elif cmd == 'stats':
+                    with self.lock:
+                        self.send_all(('stats',))
+
+                elif cmd == 'clear':
+                    os.system('clear')
+
+                elif cmd == 'rm' and args:
+                    fileid = args[0]
+                    filename = self.remove_file(fileid)
+                    if filename is None:
+                        print(f'File with id {fileid} does not exist')
+                        continue
+                    self.publish(Frame.from_message(f'File "{filename}" ({fileid}) was removed', MsgType.special))
+
+                else:
+                    print('Unknown command')
+
+            except Exception as e:
+                self.log(f'Exception in exec_commands(): {e}')
+                continue
+
+    def shutdown(self, signum, frame):
+        # SIGINT из терминала получают и рабочие; остальным передаём его сами
+        for process in self.processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+                process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        self.listener.close()
+        sys.exit(0)
+
+
+class BusClient:
+    """Связь рабочего процесса с хабом. Ответы на вызовы и рассылки читает отдельный поток"""
+
+    def __init__(self, address, authkey, server):
+        self.conn = Client(address, family='AF_UNIX', authkey=authkey)
+        self.server = server
+        self.send_lock = threading.Lock()
+        self.calls = {}  # id -> [Event, результат]
+        self.call_ids = itertools.count()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def _send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def call(self, op, *args):
+        # Вызов блокирует поток клиента (или цикл событий) на время обмена по Unix-сокету
+        call_id = next(self.call_ids)
+        waiter = self.calls[call_id] = [threading.Event(), None]
+        self._send(('call', call_id, op, args))
+        waiter[0].wait()
+        del self.calls[call_id]
+        return waiter[1]
+
+    def cast(self, op, *args):
+        self._send(('cast', op, args))
+
+    def reserve(self, name):
+        return self.call('reserve', name)
+
+    def release(self, name):
+        self.cast('release', name)
+
+    def online(self, name):
+        self.cast('online', name)
+
+    def offline(self, name):
+        self.cast('offline', name)
+
+    def names(self):
+        return self.call('names')
+
+    def channel_token(self, token, name):
+        self.cast('channel_token', token, name)
+
+    def channel_owner(self, token):
+        return self.call('channel_owner', token)
+
+    def new_fileid(self):
+        return self.call('fileid')
+
+    def commit_file(self, fileid, filename, path, digest, uploader, checksum):
+        return self.call('commit_file', fileid, filename, path, digest, uploader, checksum)
+
+    def broadcast(self, frame):
+        self.cast('broadcast', frame.msg_type.value, frame.data)
+
+    def run(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                self.server.log('Lost connection to the main process')
+                for waiter in list(self.calls.values()):
+                    waiter[0].set()
+                os.kill(os.getpid(), signal.SIGINT)
+                return
+            op = message[0]
+            if op == 'reply':
+                waiter = self.calls[message[1]]
+                waiter[1] = message[2]
+                waiter[0].set()
+            elif op == 'broadcast':
+                _, seq, msg_type, data = message
+                self.server.deliver(Frame(data, MsgType(msg_type)), seq)
+            elif op == 'file_added':
+                self.server.add_file(*message[1:])
+            elif op == 'file_removed':
+                self.server.remove_file(message[1])
+            elif op == 'kill':
+                self.server.kill_user(message[1])
+            elif op == 'sendto':
+                self.server.send_private(*message[1:])
+            elif op == 'log':
+                self.server.logger.toggle()
+            elif op == 'users':
+                print(f'# worker {os.getpid()}')
+                self.server.print_users()
+            elif op == 'stats':
+                print(f'# worker {os.getpid()}')
+                print(self.server.metrics.render(), end='')
+
+
+def run_worker(mode, options, address, authkey, index=0):
+    if options.get('metrics_port'):
+        options = {**options, 'metrics_port': options['metrics_port'] + index}
+    log_options = options.get('log_options') or {}
+    if log_options.get('path'):
+        # У каждого рабочего свой файл журнала, иначе они мешали бы друг другу при ротации
+        options = {**options, 'log_options': {**log_options, 'path': f"{log_options['path']}.{index}"}}
+    if mode == 'asyncio':
+        from async_server import AsyncChatServer
+        server = AsyncChatServer(reuse_port=True, **options)
+    else:
+        from server import ChatServer
+        server = ChatServer(reuse_port=True, **options)
+    server.console = False
+    server.bus = BusClient(address, authkey, server)
+    server.start()
+
+
+def run_cluster(workers, mode, options):
+    hub = Hub(options.get('history_db', './history.db'), options.get('files_directory', './files'))
+    hub.start_workers(workers, mode, options)
+    hub.serve()
@@ -1,6 +1,6 @@
 import tkinter as tk
 from tkinter import scrolledtext, simpledialog, messagebox, filedialog
-from base_client import ThreadSafeChatClient, thread_safe
+from base_client import ThreadSafeChatClient, thread_safe, parse_client_args
 
 @thread_safe
 class GUIChatClient(ThreadSafeChatClient):
@@ -38,6 +38,7 @@ class GUIChatClient(ThreadSafeChatClient):
         menu.add_command(label="Users Online Info", command=self._wrapper(self.get_usersinfo))
         menu.add_command(label="Upload file", command=self._wrapper(self.upload_file))
         menu.add_command(label="Download file", command=self._wrapper(self.download_file))
+        menu.add_command(label="Older messages", command=self._wrapper(self.request_history))
         self.master.config(menu=menu)
 
     def set_hotkeys(self):
@@ -47,6 +48,7 @@ class GUIChatClient(ThreadSafeChatClient):
         self.master.bind('<Control-o>', self._wrapper(self.get_usersinfo))
         self.master.bind('<Control-p>', self._wrapper(self.upload_file))
         self.master.bind('<Control-g>', self._wrapper(self.download_file))
+        self.master.bind('<Control-h>', self._wrapper(self.request_history))
         
         
     def create_chat_interface(self):
@@ -186,8 +188,7 @@ class GUIChatClient(ThreadSafeChatClient):
 
 
 if __name__ == "__main__":
+    args = parse_client_args('Tk chat client')
     root = tk.Tk()
-    client = GUIChatClient(root)
-    # client = GUIChatClient(root, port = 55555)
-    # client = GUIChatClient(root, host = 's-ia.ru', port = 5555)
+    client = GUIChatClient(root, args.host, args.port)
     root.mainloop()
@@ -1,6 +1,11 @@
+import asyncio
+import collections
 import enum
+import hashlib
 import struct
 import socket
+import threading
+import time
 import zlib
 
 
@@ -15,52 +20,452 @@ class MsgType(enum.Enum):
     put_file = enum.auto()
     get_file = enum.auto()
     empty = enum.auto()
+    file_start = enum.auto()
+    file_chunk = enum.auto()
+    file_end = enum.auto()
+    hello = enum.auto()
+    batch = enum.auto()
+    history = enum.auto()
+    ping = enum.auto()
+    pong = enum.auto()
+    channel = enum.auto()
+
+
+class Codec(enum.IntEnum):
+    zlib = 0  # Старые клиенты всегда слали и ждали zlib, поэтому это значение по умолчанию
+    raw = 1
+    zstream = 2  # Часть общего для соединения потока deflate
 
 
 class Empty(Exception):
     pass
 
 
-def send_byte_message(sock, data, msg_type=MsgType.none):
-    body = zlib.compress(data)
-    header = struct.pack('<IB', len(body), msg_type.value)
-    sock.sendall(header + body)
-
-
-def receive_byte_message(sock, throw_empty=True):
-    header_size = 5  # Размер заголовка
-    header = bytearray()
-    
-    # Получаем заголовок
-    while len(header) < header_size:
-        chunk = sock.recv(header_size - len(header))
-        if not chunk:
-            if throw_empty:
-                raise Empty
-            else:
-                return MsgType.empty, b""
-        header.extend(chunk)
+class TransferError(Exception):
+    pass
+
+
+class QueueOverflow(ConnectionError):
+    pass
+
+
+class IdleTimeout(TimeoutError):
+    """За время ожидания не начался ни один кадр; чтение можно продолжить"""
+
+
+class UnexpectedFrame(ValueError):
+    """Кадр типа, который эта сторона соединения никогда не принимает"""
+
+    def __init__(self, msg_type):
+        super().__init__(f'Unexpected message of type {msg_type.name}')
+        self.msg_type = msg_type
+
 
-    length, msg_type_code = struct.unpack('<IB', header)
+class FrameTooLarge(ValueError):
+    def __init__(self, msg_type):
+        super().__init__(f'Message of type {msg_type.name} is too large')
+        self.msg_type = msg_type
 
+
+# Заголовок: длина тела и байт типа, в старших битах которого лежит кодек
+HEADER = struct.Struct('<IB')
+TYPE_MASK = 0x1f
+CODEC_SHIFT = 5
+
+COMPRESS_THRESHOLD = 128  # Меньшие сообщения отправляются без сжатия
+PROBE_SIZE = 4096         # Размер первого блока, по которому оценивается сжимаемость
+PROBE_RATIO = 0.9         # Если первый блок сжался хуже, данные отправляются как есть
+
+STREAM_THRESHOLD = 8      # В потоковом режиме сжатие выгодно уже для коротких строк
+SYNC_TAIL = b'\x00\x00\xff\xff'  # Хвост Z_SYNC_FLUSH, не передаётся по сети
+
+# Возможности, о которых клиент и сервер договариваются при входе (MsgType.hello)
+FEATURE_CODECS = 'codec'  # Собеседник понимает кодек в заголовке; без него все кадры сжаты zlib
+FEATURE_ZSTREAM = 'zstream'
+FEATURE_BATCH = 'batch'  # Клиент умеет распаковывать кадры MsgType.batch
+FEATURE_PING = 'ping'    # Собеседник отвечает pong на ping
+FEATURE_RAW_FILES = 'rawfile'  # Клиент принимает файлы несжатым потоком без кадров (sendfile)
+FEATURE_RESUME = 'resume'      # Передачи файлов с заданного места: докачка и диапазоны
+FEATURE_CHANNEL = 'channel'    # Файлы передаются по второму соединению, не задерживая чат
+FEATURE_FIELDS = 'fields'      # Поля chatmsg, usersinfo и списка файлов с длиной, а не через NUL
+
+# Словарь для потокового сжатия: частые фразы чата, самые частые в конце
+CHAT_ZDICT = (
+    b'Nothing to download Cannot save file File cannot be downloaded '
+    b'Your file was not saved Now online are: admin (only for you) admin sent file '
+    b' was removed File  was banned uploaded file  has left the chat has joined the chat!'
+)
+
+READ_BUFFER_SIZE = 64 * 1024
+
+# Исходящая очередь соединения и что делать при её переполнении
+OUTBOUND_QUEUE_BYTES = 4 * 1024 * 1024
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # Выбросить самые старые рассылки
+OVERFLOW_DISCONNECT = 'disconnect'    # Отключить медленного клиента
+OVERFLOW_BLOCK = 'block'              # Ждать освобождения места не дольше таймаута
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT, OVERFLOW_BLOCK)
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Пределы размера кадра по типу сообщения, действуют и до, и после распаковки
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Для типов, которых нет в FRAME_LIMITS
+FRAME_LIMITS = {
+    MsgType.none: 4 * 1024,
+    MsgType.hello: 4 * 1024,
+    MsgType.put_file: 4 * 1024,
+    MsgType.usersinfo: 1024 * 1024,
+    MsgType.chatmsg: 64 * 1024,
+    MsgType.special: 64 * 1024,
+    MsgType.error: 64 * 1024,
+    MsgType.file_start: 1024,
+    MsgType.file_chunk: 2 * FILE_CHUNK_SIZE,
+    MsgType.file_end: 1024,
+    MsgType.history: 1024,
+    MsgType.ping: 64,
+    MsgType.pong: 64,
+    MsgType.channel: 1024,
+}
+REJECTED = -1  # Предел для типов, кадры которых не принимаются вовсе
+# Входящие кадры сервера: запросы клиента короткие, а типы, которые шлёт только сервер,
+# отклоняются. Заданы все типы, чтобы ни один не получил MAX_FRAME_SIZE
+REQUEST_FRAME_LIMITS = {
+    MsgType.none: 256,       # Имя, номер файла или запрос его части
+    MsgType.chatmsg: 64 * 1024,
+    MsgType.special: REJECTED,
+    MsgType.error: 256,
+    MsgType.srv_shutdown: REJECTED,
+    MsgType.ban: REJECTED,
+    MsgType.usersinfo: 64,
+    MsgType.put_file: 1024,  # Хеш, размер и имя файла
+    MsgType.get_file: 64,
+    MsgType.empty: REJECTED,
+    MsgType.file_start: 1024,
+    MsgType.file_chunk: 2 * FILE_CHUNK_SIZE,
+    MsgType.file_end: 1024,
+    MsgType.hello: 256,
+    MsgType.batch: REJECTED,
+    MsgType.history: 256,
+    MsgType.ping: 64,
+    MsgType.pong: 64,
+    MsgType.channel: 256,
+}
+FILE_END = struct.Struct('<QI')  # Размер файла и crc32
+FILE_START_RAW = struct.Struct('<BQ')  # Кодек и размер: содержимое идёт сразу за file_start без кадров
+# Передача части файла: режим, смещение, длина части, размер файла и его SHA-256.
+# Режим — кодек кадров file_chunk или FILE_UNFRAMED, если часть идёт без кадров
+FILE_START_RANGE = struct.Struct('<BQQQ32s')
+FILE_UNFRAMED = 0xff
+
+
+def pack_header(length, msg_type, codec=Codec.zlib):
+    return HEADER.pack(length, msg_type.value | (codec << CODEC_SHIFT))
+
+
+def unpack_header(header):
+    length, code = HEADER.unpack(header)
     try:
-        msg_type = MsgType(msg_type_code)
+        msg_type = MsgType(code & TYPE_MASK)
+        codec = Codec(code >> CODEC_SHIFT)
     except ValueError:
         raise ValueError('Invalid message type')
+    return length, msg_type, codec
 
-    buf_size = 2048
-    data = bytearray()
-    while len(data) < length:
-        to_read = min(buf_size, length - len(data))
-        buf = sock.recv(to_read)
-        if not buf:
-            if throw_empty:
-                raise Empty
+
+def encode_body(data, compress=True, codecs=True):
+    if not codecs:
+        # Старый собеседник распаковывает zlib каждый кадр и не знает других кодеков
+        return Codec.zlib, zlib.compress(data)
+    if not compress or len(data) < COMPRESS_THRESHOLD:
+        return Codec.raw, data
+
+    if len(data) > PROBE_SIZE:
+        probe = zlib.compress(data[:PROBE_SIZE], 1)
+        if len(probe) > PROBE_SIZE * PROBE_RATIO:
+            return Codec.raw, data
+
+    body = zlib.compress(data)
+    if len(body) >= len(data):
+        return Codec.raw, data
+    return Codec.zlib, body
+
+
+def decode_body(codec, body, stream=None, max_length=0):
+    """Распаковывает тело кадра; если результат длиннее max_length, возвращает None"""
+    if codec == Codec.zlib:
+        if not max_length:
+            return zlib.decompress(body)
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(body, max_length)
+        if decompressor.unconsumed_tail:
+            return None
+        return data
+    if codec == Codec.zstream:
+        if stream is None:
+            raise ValueError('Unexpected stream-compressed message')
+        return stream.decompress(body, max_length)
+    return body
+
+
+def frame_limit(msg_type, limits=FRAME_LIMITS):
+    return limits.get(msg_type, MAX_FRAME_SIZE)
+
+
+def decode_frame(msg_type, codec, body, stream=None, limits=FRAME_LIMITS):
+    data = decode_body(codec, body, stream, frame_limit(msg_type, limits))
+    if data is None:
+        raise FrameTooLarge(msg_type)
+    return data
+
+
+class StreamCompressor:
+    """Сжатие всех кадров соединения одним потоком deflate (кодек zstream)"""
+
+    def __init__(self, zdict=CHAT_ZDICT):
+        self.compressor = zlib.compressobj(zdict=zdict)
+
+    def build_frame(self, data, msg_type=MsgType.none, compress=True):
+        # Несжатые кадры не затрагивают состояние потока
+        if not compress or len(data) < STREAM_THRESHOLD:
+            return build_frame(data, msg_type, compress=False)
+        body = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        body = body[:-len(SYNC_TAIL)]
+        return pack_header(len(body), msg_type, Codec.zstream) + body
+
+
+class StreamDecompressor:
+    def __init__(self, zdict=CHAT_ZDICT):
+        self.decompressor = zlib.decompressobj(zdict=zdict)
+
+    def decompress(self, body, max_length=0):
+        """Возвращает None, если результат длиннее max_length"""
+        data = self.decompressor.decompress(body, max_length)
+        if self.decompressor.unconsumed_tail:
+            # Остаток распаковывается порциями и выбрасывается, чтобы не сбить состояние потока
+            while self.decompressor.unconsumed_tail:
+                self.decompressor.decompress(self.decompressor.unconsumed_tail, READ_BUFFER_SIZE)
+            data = None
+        tail = self.decompressor.decompress(SYNC_TAIL)
+        if data is None or (max_length and len(data) + len(tail) > max_length):
+            return None
+        return data + tail
+
+    def skip(self, body):
+        """Часть тела отклонённого кадра: распакованное выбрасывается, но попадает в историю
+        потока, иначе следующие кадры со ссылками назад распакуются в мусор"""
+        self.decompressor.decompress(body, READ_BUFFER_SIZE)
+        while self.decompressor.unconsumed_tail:
+            self.decompressor.decompress(self.decompressor.unconsumed_tail, READ_BUFFER_SIZE)
+
+    def skip_end(self):
+        self.skip(SYNC_TAIL)
+
+
+def build_frame(data, msg_type=MsgType.none, compress=True, codecs=True):
+    """Собирает готовый кадр, который можно отправить сразу нескольким получателям"""
+    codec, body = encode_body(data, compress, codecs)
+    return pack_header(len(body), msg_type, codec) + body
+
+
+class Frame:
+    """Исходящее сообщение, кадр для которого собирается один раз на всех получателей"""
+
+    def __init__(self, data, msg_type=MsgType.none):
+        self.data = data
+        self.msg_type = msg_type
+        self._raw = None
+        self._zlib_raw = None
+        self._legacy = None
+
+    @classmethod
+    def from_message(cls, msg, msg_type=MsgType.none, encoding='utf8'):
+        return cls(msg.encode(encoding), msg_type)
+
+    @property
+    def raw(self):
+        if self._raw is None:
+            self._raw = build_frame(self.data, self.msg_type)
+        return self._raw
+
+    @property
+    def legacy(self):
+        """Тот же кадр с полями через NUL для собеседников без FEATURE_FIELDS"""
+        if self._legacy is None:
+            if self.msg_type in FIELD_TYPES:
+                self._legacy = Frame(legacy_fields(self.data), self.msg_type)
             else:
-                return MsgType.empty, b""
-        data.extend(buf)
+                self._legacy = self
+        return self._legacy
+
+    @property
+    def zlib_raw(self):
+        """Кадр для собеседников без FEATURE_CODECS"""
+        if self._zlib_raw is None:
+            self._zlib_raw = build_frame(self.data, self.msg_type, codecs=False)
+        return self._zlib_raw
+
+
+def batch_payload(frames):
+    return b''.join(build_frame(f.data, f.msg_type, compress=False) for f in frames)
+
+
+class BatchFrame(Frame):
+    """Кадр batch из готовых кадров. Сжимается один раз, как и Frame,
+    а вложенные кадры остаются доступны для клиентов без поддержки batch"""
+
+    def __init__(self, frames):
+        self.frames = tuple(frames)
+        super().__init__(batch_payload(self.frames), MsgType.batch)
+
 
-    data = zlib.decompress(data)
+class SocketOptions:
+    """Настройки TCP-сокета, общие для сервера и клиентов. По умолчанию — низкая задержка:
+    TCP_NODELAY, чтобы короткие кадры не ждали алгоритма Нейгла, и keepalive для обнаружения
+    пропавших соединений. Размеры буферов 0 оставляют автонастройку системы"""
+
+    def __init__(self, nodelay=True, keepalive=True, keepidle=60, keepintvl=10, keepcnt=5,
+                 sndbuf=0, rcvbuf=0):
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.keepidle = keepidle
+        self.keepintvl = keepintvl
+        self.keepcnt = keepcnt
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+
+    def apply(self, sock):
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(self.keepalive))
+        if not self.keepalive:
+            return
+        # Имена параметров keepalive различаются по платформам
+        idle = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))
+        for option, value in ((idle, self.keepidle),
+                              (getattr(socket, 'TCP_KEEPINTVL', None), self.keepintvl),
+                              (getattr(socket, 'TCP_KEEPCNT', None), self.keepcnt)):
+            if option is not None and value:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--no-nodelay', action='store_true',
+                            help='keep Nagle\'s algorithm enabled (TCP_NODELAY off)')
+        parser.add_argument('--no-keepalive', action='store_true', help='disable TCP keepalive')
+        parser.add_argument('--keepidle', type=int, default=60,
+                            help='seconds of silence before the first keepalive probe')
+        parser.add_argument('--keepintvl', type=int, default=10, help='seconds between keepalive probes')
+        parser.add_argument('--keepcnt', type=int, default=5,
+                            help='unanswered probes before the connection is dropped')
+        parser.add_argument('--sndbuf', type=int, default=0, help='SO_SNDBUF in bytes, 0 for the system default')
+        parser.add_argument('--rcvbuf', type=int, default=0, help='SO_RCVBUF in bytes, 0 for the system default')
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(not args.no_nodelay, not args.no_keepalive, args.keepidle, args.keepintvl,
+                   args.keepcnt, args.sndbuf, args.rcvbuf)
+
+
+class Heartbeat:
+    """Проверка живости соединения со стороны читающего. Чтение ждёт данных не дольше
+    read_timeout; после idle_timeout секунд тишины собеседнику уходит ping, и если за следующие
+    read_timeout секунд не пришло ни одного кадра, соединение считается оборванным.
+    Собеседнику без FEATURE_PING даётся idle_timeout + read_timeout секунд тишины"""
+
+    def __init__(self, idle_timeout=60, read_timeout=30):
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.silent = 0  # Сколько секунд подряд не было кадров
+        self.pinged = False
+        self.holds = 0   # Исходящие передачи файлов, во время которых тишина ожидаема
+        self.lock = threading.Lock()
+
+    def hold(self):
+        """Собеседник занят приёмом файла, а ping стоит в очереди за ним:
+        до release его молчание не считается"""
+        with self.lock:
+            self.holds += 1
+
+    def release(self):
+        with self.lock:
+            self.holds -= 1
+        self.reset()
+
+    def reset(self):
+        self.silent = 0
+        self.pinged = False
+
+    def expired(self, writer=None):
+        """Вызывается, когда за read_timeout не начался ни один кадр; writer — куда слать ping.
+        Возвращает True, если соединение пора закрыть"""
+        if self.holds:
+            self.reset()
+            return False
+        if self.pinged:
+            return True
+        self.silent += self.read_timeout
+        if writer is None:
+            return self.silent >= self.idle_timeout + self.read_timeout
+        if self.silent >= self.idle_timeout:
+            writer.send_byte_message(b'', MsgType.ping)
+            self.pinged = True
+        return False
+
+    @staticmethod
+    def add_arguments(parser, idle_timeout, read_timeout):
+        parser.add_argument('--idle-timeout', type=float, default=idle_timeout,
+                            help='seconds of silence before pinging the other side (0 disables timeouts)')
+        parser.add_argument('--read-timeout', type=float, default=read_timeout,
+                            help='seconds to wait for an answer to ping or for the rest of a message')
+
+
+def send_frame(sock, frame):
+    sock.sendall(frame.raw)
+
+
+def send_byte_message(sock, data, msg_type=MsgType.none, compress=True):
+    sock.sendall(build_frame(data, msg_type, compress))
+
+
+def recv_into_exactly(sock, view):
+    """Заполняет view целиком, при закрытии соединения возвращает False"""
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:])
+        if not n:
+            return False
+        received += n
+    return True
+
+
+def recv_exactly(sock, size):
+    """Читает ровно size байт в заранее выделенный буфер, при закрытии соединения возвращает None"""
+    buf = bytearray(size)
+    if not recv_into_exactly(sock, memoryview(buf)):
+        return None
+    return buf
+
+
+def receive_byte_message(sock, throw_empty=True, limits=FRAME_LIMITS):
+    """Читает кадр без буферизации; после FrameTooLarge соединение нужно закрыть"""
+    header = recv_exactly(sock, HEADER.size)
+    if header is not None:
+        length, msg_type, codec = unpack_header(header)
+        limit = frame_limit(msg_type, limits)
+        if limit == REJECTED:
+            raise UnexpectedFrame(msg_type)
+        if length > limit:
+            raise FrameTooLarge(msg_type)
+        data = recv_exactly(sock, length)
+
+    if header is None or data is None:
+        if throw_empty:
+            raise Empty
+        else:
+            return MsgType.empty, b""
+
+    data = decode_frame(msg_type, codec, data, limits=limits)
     return msg_type, data
 
 
@@ -71,3 +476,1036 @@ def send_message(sock, msg, msg_type=MsgType.none, encoding='utf8'):
 def receive_message(sock, throw_empty=True, encoding='utf8'):
     msg_type, data = receive_byte_message(sock, throw_empty)
     return msg_type, data.decode(encoding)
+
+
+
+# Структурированные данные (chatmsg, usersinfo, get_file): последовательность полей,
+# каждое с длиной в формате varint, поэтому внутри полей допустимы любые символы.
+# Собеседникам без FEATURE_FIELDS поля уходят по-старому, через NUL
+
+FIELD_TYPES = (MsgType.chatmsg, MsgType.usersinfo, MsgType.get_file)
+
+def encode_fields(*fields, encoding='utf8'):
+    out = bytearray()
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode(encoding)
+        length = len(field)
+        while length >= 0x80:
+            out.append(length & 0x7f | 0x80)
+            length >>= 7
+        out.append(length)
+        out += field
+    return bytes(out)
+
+
+def iter_fields(data, encoding='utf8'):
+    view = memoryview(data)
+    pos = 0
+    while pos < len(view):
+        length = shift = 0
+        while True:
+            if pos >= len(view):
+                raise ValueError('Truncated field length')
+            byte = view[pos]
+            pos += 1
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        if pos + length > len(view):
+            raise ValueError('Truncated field')
+        yield str(view[pos:pos + length], encoding)
+        pos += length
+
+
+def decode_fields(data, encoding='utf8', legacy=False):
+    if legacy:
+        return str(data, encoding).split('\0') if data else []
+    return list(iter_fields(data, encoding))
+
+
+def legacy_fields(data, encoding='utf8'):
+    return '\0'.join(iter_fields(data, encoding)).encode(encoding)
+
+
+class FrameReader:
+    """Буферизованное чтение кадров: одним recv забирается сразу много кадров"""
+
+    def __init__(self, sock, buf_size=READ_BUFFER_SIZE, limits=FRAME_LIMITS, heartbeat=None):
+        self.sock = sock
+        self.limits = limits
+        self.buf = bytearray(buf_size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # Начало ещё не разобранных данных
+        self.end = 0    # Конец прочитанных данных
+        self.stream = None  # StreamDecompressor после согласования zstream
+        self.metrics = None  # Metrics из metrics.py, если нужна статистика
+        self.writer = None   # Отвечает на ping; задаётся при согласовании FEATURE_PING
+        self.heartbeat = None
+        if heartbeat is not None:
+            self.set_heartbeat(heartbeat)
+
+    def set_heartbeat(self, heartbeat):
+        """Heartbeat ограничивает ожидание данных, None снимает ограничение"""
+        self.heartbeat = heartbeat
+        # Таймаут сокета действует и на отправку: запись мёртвому собеседнику тоже прервётся
+        self.sock.settimeout(heartbeat.read_timeout if heartbeat is not None else None)
+
+    def _fill(self, size):
+        """Дочитывает из сокета, пока в буфере не окажется size байт"""
+        while self.end - self.start < size:
+            if self.start + size > len(self.buf):
+                # Сдвигаем остаток в начало, чтобы кадр поместился целиком
+                remaining = self.end - self.start
+                self.view[:remaining] = self.view[self.start:self.end]
+                self.start, self.end = 0, remaining
+            n = self.sock.recv_into(self.view[self.end:])
+            if not n:
+                return False
+            self.end += n
+        return True
+
+    def _skip(self, length, stream=None):
+        """Пропускает тело отклонённого кадра, не выделяя под него память.
+        Тело кадра zstream проходит через stream, чтобы не сбить состояние потока"""
+        while length:
+            if self.start == self.end:
+                self.start = 0
+                self.end = self.sock.recv_into(self.view)
+                if not self.end:
+                    return False
+            step = min(length, self.end - self.start)
+            if stream is not None:
+                stream.skip(self.view[self.start:self.start + step])
+            self.start += step
+            length -= step
+        if stream is not None:
+            stream.skip_end()
+        return True
+
+    def _read_large(self, length):
+        """Кадр больше буфера: остаток дочитывается прямо в отдельный буфер"""
+        body = bytearray(length)
+        view = memoryview(body)
+        buffered = self.end - self.start
+        view[:buffered] = self.view[self.start:self.end]
+        self.start = self.end = 0
+        if not recv_into_exactly(self.sock, view[buffered:]):
+            return None
+        return body
+
+    def read_raw(self, size):
+        """Отдаёт порциями size байт, идущих в соединении без кадров. Порция — срез
+        буфера чтения, её нужно использовать до следующей"""
+        if self.metrics is not None:
+            self.metrics.frame_in(MsgType.file_chunk, size, size)
+        while size:
+            if self.start == self.end:
+                self.start = 0
+                self.end = self.sock.recv_into(self.view)
+                if not self.end:
+                    raise Empty
+            step = min(size, self.end - self.start)
+            yield self.view[self.start:self.start + step]
+            self.start += step
+            size -= step
+
+    def read_frame(self):
+        """Возвращает (msg_type, data) или None, если соединение закрыто.
+        ping и pong обрабатываются здесь и наружу не попадают"""
+        while True:
+            try:
+                frame = self._read_frame()
+            except IdleTimeout:
+                if self.heartbeat is None or self.heartbeat.expired(self.writer):
+                    raise TimeoutError('Connection timed out')
+                continue
+            if frame is None:
+                return None
+            if self.metrics is not None:
+                self.metrics.frame_in(frame[0], len(frame[1]), self.wire_size)
+            if self.heartbeat is not None:
+                self.heartbeat.reset()
+            if not control_frame(self, *frame):
+                return frame
+
+    def _read_frame(self):
+        try:
+            if not self._fill(HEADER.size):
+                return None
+        except socket.timeout:
+            # Недочитанный заголовок остаётся в буфере, поэтому чтение можно повторить
+            raise IdleTimeout
+        length, msg_type, codec = unpack_header(self.view[self.start:self.start + HEADER.size])
+        self.start += HEADER.size
+        self.wire_size = HEADER.size + length
+
+        limit = frame_limit(msg_type, self.limits)
+        if limit == REJECTED:
+            # Такой кадр не пропустить: соединение закрывается, тело не читается
+            raise UnexpectedFrame(msg_type)
+        if length > limit:
+            if not self._skip(length, self.stream if codec == Codec.zstream else None):
+                return None
+            raise FrameTooLarge(msg_type)
+
+        if length > len(self.buf):
+            body = self._read_large(length)
+            if body is None:
+                return None
+            return msg_type, decode_frame(msg_type, codec, body, self.stream, self.limits)
+
+        if not self._fill(length):
+            return None
+        body = self.view[self.start:self.start + length]
+        self.start += length
+        data = decode_frame(msg_type, codec, body, self.stream, self.limits)
+        if data is body:
+            data = bytes(body)  # Буфер будет переиспользован
+        return msg_type, data
+
+    def __iter__(self):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def receive_byte_message(self, throw_empty=True):
+        frame = self.read_frame()
+        if frame is None:
+            if throw_empty:
+                raise Empty
+            else:
+                return MsgType.empty, b""
+        return frame
+
+    def receive_message(self, throw_empty=True, encoding='utf8'):
+        msg_type, data = self.receive_byte_message(throw_empty)
+        return msg_type, data.decode(encoding)
+
+
+class FrameWriter:
+    """Отправка кадров в соединение; кадры из разных потоков не перемешиваются"""
+
+    def __init__(self, sock, coalescer=None):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.stream = None  # StreamCompressor после согласования zstream
+        self.features = set()
+        self.codecs = False  # Кодеки, кроме zlib, только после согласования FEATURE_CODECS
+        self.fields = False  # Поля с длиной только после согласования FEATURE_FIELDS
+        self.coalescer = coalescer
+        self.pending = []  # Кадры, ожидающие упаковки в batch
+        self.pending_size = 0
+        self.metrics = None  # Metrics из metrics.py, если нужна статистика
+        # Время кадров в исходящей очереди этого клиента: сумма, число и максимум
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.latency_max = 0.0
+
+    def _sent(self, queued):
+        """Учесть задержку отправки кадра, поставленного в очередь в момент queued"""
+        latency = time.monotonic() - queued
+        self.latency_sum += latency
+        self.latency_count += 1
+        self.latency_max = max(self.latency_max, latency)
+        if self.metrics is not None:
+            self.metrics.send_latency(latency)
+
+    def _send(self, raw):
+        self.sock.sendall(raw)
+
+    def _out(self, raw, msg_type, size):
+        """Отправка кадра с учётом в статистике; size — объём данных до сжатия"""
+        if self.metrics is not None:
+            self.metrics.frame_out(msg_type, size, len(raw))
+        self._send(raw)
+
+    def _encode(self, data, msg_type, compress=True):
+        if not self.fields and msg_type in FIELD_TYPES:
+            data = legacy_fields(data)
+        if self.stream is None:
+            return build_frame(data, msg_type, compress, self.codecs)
+        return self.stream.build_frame(data, msg_type, compress)
+
+    def _encode_frame(self, frame):
+        if not self.fields:
+            frame = frame.legacy
+        if self.stream is None:
+            return frame.raw if self.codecs else frame.zlib_raw
+        return self.stream.build_frame(frame.data, frame.msg_type)
+
+    def _flush_locked(self, cache=None):
+        if not self.pending:
+            return
+        pending = tuple(self.pending)
+        self.pending.clear()
+        self.pending_size = 0
+
+        if len(pending) == 1:
+            self._out(self._encode_frame(pending[0]), pending[0].msg_type, len(pending[0].data))
+            return
+
+        # Одинаковые пачки для соединений без потокового сжатия собираются один раз
+        shared = cache is not None and self.stream is None and self.codecs
+        raw = cache.get(pending) if shared else None
+        if raw is None:
+            raw = self._encode(batch_payload(pending), MsgType.batch)
+            if shared:
+                cache[pending] = raw
+        self._out(raw, MsgType.batch, sum(len(f.data) for f in pending))
+
+    def flush(self, cache=None):
+        with self.lock:
+            self._flush_locked(cache)
+
+    def write(self, raw):
+        # Готовый кадр (часть файла): размер до сжатия неизвестен, считается по проводу
+        with self.lock:
+            self._flush_locked()
+            self._out(raw, unpack_header(raw[:HEADER.size])[1], len(raw))
+
+    def send_frame(self, frame):
+        if self.coalescer is not None and FEATURE_BATCH in self.features:
+            with self.lock:
+                self.pending.append(frame)
+                self.pending_size += len(frame.data)
+                if self.pending_size >= self.coalescer.max_bytes:
+                    self._flush_locked()
+                    return
+            self.coalescer.schedule(self)
+            return
+
+        with self.lock:
+            self._flush_locked()
+            self._out(self._encode_frame(frame), frame.msg_type, len(frame.data))
+
+    def send_reply(self, frame):
+        """Ответ на запрос готовым кадром: не ждёт batch и не выбрасывается из очереди,
+        ведь клиент ждёт именно его"""
+        with self.lock:
+            self._flush_locked()
+            self._out(self._encode_frame(frame), frame.msg_type, len(frame.data))
+
+    def send_snapshot(self, snapshot):
+        """Отправляет BatchFrame уже сжатым кадром, а без batch — по одному вложенному кадру"""
+        if not snapshot.frames:
+            return
+        with self.lock:
+            self._flush_locked()
+            if FEATURE_BATCH in self.features:
+                self._out(snapshot.raw, MsgType.batch, len(snapshot.data))
+            else:
+                for frame in snapshot.frames:
+                    self._out(self._encode_frame(frame), frame.msg_type, len(frame.data))
+
+    def set_features(self, features):
+        """Согласованные возможности видны сразу, а кодек и формат полей меняются в порядке отправки"""
+        self.features = set(features)
+        self._switch_encoding(self.features)
+
+    def _switch_encoding(self, features):
+        with self.lock:
+            self.codecs = FEATURE_CODECS in features
+            self.fields = FEATURE_FIELDS in features
+            if FEATURE_ZSTREAM in features:
+                self.stream = StreamCompressor()
+
+    def send_byte_message(self, data, msg_type=MsgType.none, compress=True):
+        # Сжатие и отправка под одной блокировкой, чтобы порядок в потоке совпадал
+        with self.lock:
+            self._flush_locked()
+            self._out(self._encode(data, msg_type, compress), msg_type, len(data))
+
+    def send_message(self, msg, msg_type=MsgType.none, encoding='utf8'):
+        self.send_byte_message(msg.encode(encoding), msg_type)
+
+    def send_file(self, f, size, on_sent=None, offset=0):
+        """Отправляет size байт файла с offset через sendfile, не читая их в память процесса.
+        Файл переходит к писателю и закрывается после отправки, затем вызывается on_sent"""
+        with f, self.lock:
+            self._flush_locked()
+            if self.metrics is not None:
+                self.metrics.frame_out(MsgType.file_chunk, size, size)
+            end = offset + size
+            while offset < end:  # sendfile не принимает нулевую длину
+                try:
+                    self.sock.sendfile(f, offset, end - offset)
+                    break
+                except socket.timeout:
+                    # Таймаут сокета общий с чтением; пока собеседник принимает данные,
+                    # медленная загрузка не считается зависанием
+                    if f.tell() <= offset:
+                        raise
+                    offset = f.tell()
+        if on_sent is not None:
+            on_sent()
+
+    def close(self):
+        # shutdown будит поток, заблокированный в recv на этом сокете
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Coalescer:
+    """Откладывает отправку кадров на window секунд, чтобы упаковать их в один batch"""
+
+    def __init__(self, window=0.002, max_bytes=16 * 1024):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.dirty = set()
+        self.cond = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def schedule(self, writer):
+        with self.cond:
+            self.dirty.add(writer)
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.dirty:
+                    self.cond.wait()
+            time.sleep(self.window)
+            with self.cond:
+                writers, self.dirty = self.dirty, set()
+            self.flush_writers(writers)
+
+    def flush_writers(self, writers):
+        cache = {}
+        for writer in writers:
+            try:
+                writer.flush(cache)
+            except OSError:
+                # Читающая сторона увидит закрытое соединение и удалит клиента
+                writer.close()
+
+
+class OutboundQueue:
+    """Ограниченная по объёму очередь отложенных вызовов FrameWriter.
+    Выбрасывать можно только рассылки (send_frame): они ещё не сжаты, поэтому
+    пропуск не нарушает состояние потокового сжатия"""
+
+    def __init__(self, max_bytes=OUTBOUND_QUEUE_BYTES, overflow=OVERFLOW_DISCONNECT):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy: {overflow}')
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.items = collections.deque()  # (size, droppable, method, args, время постановки)
+        self.size = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def fits(self, size):
+        return not self.items or self.size + size <= self.max_bytes
+
+    def drop_oldest(self, size):
+        kept = collections.deque()
+        while self.items and self.size + size > self.max_bytes:
+            item = self.items.popleft()
+            if item[1]:
+                self.size -= item[0]
+            else:
+                kept.append(item)
+        kept.extend(self.items)
+        self.items = kept
+        return self.fits(size)
+
+    def push(self, size, droppable, method, args):
+        self.items.append((size, droppable, method, args, time.monotonic()))
+        self.size += size
+
+    def pop(self):
+        size, _, method, args, queued = self.items.popleft()
+        self.size -= size
+        return method, args, queued
+
+
+class QueuedFrameWriter(FrameWriter):
+    """FrameWriter с ограниченной исходящей очередью, которую разбирает один поток-писатель.
+    Вызывающий поток не ждёт сети, поэтому медленный клиент не задерживает рассылку остальным"""
+
+    def __init__(self, sock, coalescer=None, max_bytes=OUTBOUND_QUEUE_BYTES,
+                 overflow=OVERFLOW_DISCONNECT, timeout=1.0):
+        super().__init__(sock, coalescer)
+        self.queue = OutboundQueue(max_bytes, overflow)
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.closing = False
+        self.closed = False
+        self.done = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def _put(self, size, droppable, method, *args, block=False):
+        with self.cond:
+            if self.closing:
+                raise QueueOverflow('Connection is closed')
+            if not self.queue.fits(size):
+                if block or self.queue.overflow == OVERFLOW_BLOCK:
+                    # Файлы отправляет поток самого клиента, ему можно ждать без ограничения
+                    timeout = None if block else self.timeout
+                    if not self.cond.wait_for(lambda: self.closing or self.queue.fits(size), timeout):
+                        raise QueueOverflow('Outbound queue is full')
+                    if self.closing:
+                        raise QueueOverflow('Connection is closed')
+                elif self.queue.overflow == OVERFLOW_DROP_OLDEST:
+                    # Ответы и части файлов не выбрасываются, поэтому очередь может немного превысить предел
+                    self.queue.drop_oldest(size)
+                else:
+                    raise QueueOverflow('Outbound queue is full')
+            self.queue.push(size, droppable, method, args)
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                method, args, queued = self.queue.pop()
+                self.cond.notify_all()
+            try:
+                method(*args)
+            except OSError:
+                self._close_now()
+                return
+            self._sent(queued)
+
+    def write(self, raw):
+        self._put(len(raw), False, super().write, raw, block=True)
+
+    def flush(self, cache=None):
+        self._put(0, False, super().flush, cache)
+
+    def send_frame(self, frame):
+        self._put(len(frame.data), True, super().send_frame, frame)
+
+    def send_reply(self, frame):
+        self._put(len(frame.data), False, super().send_reply, frame)
+
+    def send_snapshot(self, snapshot):
+        # Снимок истории ставится в очередь целиком и никогда не выбрасывается
+        self._put(0, False, super().send_snapshot, snapshot)
+
+    def _switch_encoding(self, features):
+        # Меняется в порядке очереди, чтобы уже поставленные кадры сжались по-старому
+        self._put(0, False, super()._switch_encoding, features)
+
+    def send_byte_message(self, data, msg_type=MsgType.none, compress=True):
+        self._put(len(data), False, super().send_byte_message, data, msg_type, compress)
+
+    def send_file(self, f, size, on_sent=None, offset=0):
+        # Файл не занимает места в очереди: данные берутся из кэша страниц при отправке
+        self._put(0, False, super().send_file, f, size, on_sent, offset, block=True)
+
+    def close(self):
+        """Закрывает соединение после отправки уже поставленного в очередь, но не позже timeout"""
+        with self.cond:
+            if self.closing:
+                return
+            self.closing = True
+            self.queue.push(0, False, self._close_now, ())
+            self.cond.notify_all()
+        timer = threading.Timer(self.timeout, self._close_now)
+        timer.daemon = True
+        timer.start()
+
+    def _close_now(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closing = self.closed = True
+            self.cond.notify_all()
+        super().close()
+        self.done.set()
+
+    def wait_closed(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+def iter_batch(data):
+    """Разбирает содержимое кадра batch на вложенные (msg_type, data)"""
+    view = memoryview(data)
+    pos = 0
+    while pos < len(view):
+        if pos + HEADER.size > len(view):
+            raise ValueError('Truncated batch')
+        length, msg_type, codec = unpack_header(view[pos:pos + HEADER.size])
+        pos += HEADER.size
+        if pos + length > len(view):
+            raise ValueError('Truncated batch')
+        yield msg_type, bytes(decode_frame(msg_type, codec, view[pos:pos + length]))
+        pos += length
+
+
+def apply_features(reader, writer, features):
+    if FEATURE_ZSTREAM in features:
+        reader.stream = StreamDecompressor()
+    if FEATURE_PING in features:
+        reader.writer = writer
+    writer.set_features(features)
+
+
+def control_frame(reader, msg_type, data):
+    """Отвечает на ping; возвращает True для служебных кадров, которые дальше не передаются"""
+    if msg_type == MsgType.ping:
+        if reader.writer is not None:
+            reader.writer.send_byte_message(data, MsgType.pong)
+        return True
+    return msg_type == MsgType.pong
+
+
+# Потоковая передача файлов: file_start (кодек потока), несколько file_chunk
+# ограниченного размера и file_end с размером и контрольной суммой
+
+TRANSFER_TYPES = (MsgType.error, MsgType.file_start, MsgType.file_chunk, MsgType.file_end)
+
+
+def file_frames(f, chunk_size=FILE_CHUNK_SIZE, start=None):
+    """Кадры передачи f с текущей позиции; start(codec) возвращает тело file_start,
+    по умолчанию это один байт кодека"""
+    chunk = f.read(chunk_size)
+    codec, _ = encode_body(chunk[:PROBE_SIZE])
+    compressor = zlib.compressobj() if codec == Codec.zlib else None
+    body = bytes([codec]) if start is None else start(codec)
+    yield pack_header(len(body), MsgType.file_start, Codec.raw) + body
+
+    size = 0
+    crc = 0
+    while chunk:
+        size += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+        if compressor:
+            chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield pack_header(len(chunk), MsgType.file_chunk, Codec.raw) + chunk
+        chunk = f.read(chunk_size)
+
+    yield pack_header(FILE_END.size, MsgType.file_end, Codec.raw) + FILE_END.pack(size, crc)
+
+
+class FileReceiver:
+    """Приём кадров передачи в файл f. Для передачи части файла вызывается
+    on_range(offset, total, digest) и возвращает файл, в который писать"""
+
+    def __init__(self, f, on_range=None):
+        self.f = f
+        self.on_range = on_range
+        self.started = False
+        self.decompressor = None
+        self.size = 0
+        self.crc = 0
+        self.raw_size = 0  # Сколько байт без кадров ждать после file_start
+        self.write_error = None
+
+    def feed(self, msg_type, data):
+        """Обрабатывает очередной кадр передачи, возвращает True после file_end"""
+        if msg_type == MsgType.file_start:
+            if len(data) == FILE_START_RANGE.size:
+                mode, offset, length, total, digest = FILE_START_RANGE.unpack(data)
+                if self.on_range is not None:
+                    try:
+                        self.f = self.on_range(offset, total, digest.hex())
+                    except OSError as e:
+                        self.write_error = e
+                if mode == FILE_UNFRAMED:
+                    self.raw_size = length
+                elif Codec(mode) == Codec.zlib:
+                    self.decompressor = zlib.decompressobj()
+            elif len(data) == FILE_START_RAW.size:
+                _, self.raw_size = FILE_START_RAW.unpack(data)
+            elif Codec(data[0]) == Codec.zlib:
+                self.decompressor = zlib.decompressobj()
+            self.started = True
+
+        elif msg_type == MsgType.file_chunk and self.started:
+            if self.decompressor:
+                data = self.decompressor.decompress(data, frame_limit(MsgType.file_chunk))
+                if self.decompressor.unconsumed_tail:
+                    raise TransferError('File chunk is too large')
+            self.write(data)
+
+        elif msg_type == MsgType.file_end and self.started:
+            if (self.size, self.crc) != FILE_END.unpack(data):
+                raise TransferError('Checksum mismatch')
+            if self.write_error is not None:
+                raise self.write_error
+            return True
+
+        else:
+            raise TransferError('Transfer interrupted')
+
+        return False
+
+    def write(self, data):
+        self.size += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        # Ошибку записи запоминаем и дочитываем поток, чтобы не потерять синхронизацию
+        if self.write_error is None:
+            try:
+                self.f.write(data)
+            except OSError as e:
+                self.write_error = e
+
+
+def send_file_stream(writer, f, start=None):
+    for raw in file_frames(f, start=start):
+        writer.write(raw)
+
+
+def send_file_raw(writer, f, size, crc, on_sent=None):
+    """Передача без сжатия и кадров: file_start с размером, содержимое через sendfile, file_end.
+    Контрольную сумму отправитель знает заранее, файл после вызова принадлежит писателю"""
+    writer.write(pack_header(FILE_START_RAW.size, MsgType.file_start, Codec.raw)
+                 + FILE_START_RAW.pack(Codec.raw, size))
+    writer.send_file(f, size, on_sent)
+    writer.write(pack_header(FILE_END.size, MsgType.file_end, Codec.raw) + FILE_END.pack(size, crc))
+
+
+def send_file_range(writer, f, offset, size, total, digest, crc, on_sent=None):
+    """Часть файла без кадров через sendfile; crc — контрольная сумма этой части"""
+    writer.write(pack_header(FILE_START_RANGE.size, MsgType.file_start, Codec.raw)
+                 + FILE_START_RANGE.pack(FILE_UNFRAMED, offset, size, total, bytes.fromhex(digest)))
+    writer.send_file(f, size, on_sent, offset)
+    writer.write(pack_header(FILE_END.size, MsgType.file_end, Codec.raw) + FILE_END.pack(size, crc))
+
+
+def file_checksum(f, offset=0, size=None, chunk_size=FILE_CHUNK_SIZE):
+    """Размер и crc32 части файла (по умолчанию всего), как в file_end"""
+    f.seek(offset)
+    remaining = -1 if size is None else size
+    size = 0
+    crc = 0
+    chunk = f.read(chunk_size if remaining < 0 else min(chunk_size, remaining))
+    while chunk:
+        size += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+        remaining -= len(chunk)
+        chunk = f.read(chunk_size if remaining < 0 else min(chunk_size, remaining))
+    f.seek(0)
+    return size, crc
+
+
+def file_digest(f, chunk_size=1024 * 1024):
+    """SHA-256 файла в шестнадцатеричном виде и его размер"""
+    f.seek(0)
+    digest = hashlib.sha256()
+    size = 0
+    chunk = f.read(chunk_size)
+    while chunk:
+        digest.update(chunk)
+        size += len(chunk)
+        chunk = f.read(chunk_size)
+    f.seek(0)
+    return digest.hexdigest(), size
+
+
+def receive_file_stream(reader, f, on_other=None, on_range=None):
+    """Принимает файл в f из FrameReader; посторонние кадры (кроме error) передаются в on_other"""
+    receiver = FileReceiver(f, on_range)
+    while True:
+        msg_type, data = reader.receive_byte_message()
+        if on_other and msg_type not in TRANSFER_TYPES:
+            on_other(msg_type, data)
+        elif receiver.feed(msg_type, data):
+            return receiver.size
+        elif receiver.raw_size:
+            for chunk in reader.read_raw(receiver.raw_size):
+                receiver.write(chunk)
+            receiver.raw_size = 0
+
+
+
+# Асинхронный вариант протокола поверх asyncio.StreamReader/StreamWriter.
+# Заголовок, кодеки и кадры файлов общие с синхронными функциями
+
+async def read_frame(reader, throw_empty=True, stream=None, limits=FRAME_LIMITS, metrics=None, timeout=None):
+    """timeout ограничивает ожидание начала кадра (IdleTimeout) и его тела (TimeoutError)"""
+    try:
+        if timeout is None:
+            header = await reader.readexactly(HEADER.size)
+        else:
+            try:
+                # Отменённый readexactly ничего не забирает из буфера StreamReader
+                header = await asyncio.wait_for(reader.readexactly(HEADER.size), timeout)
+            except asyncio.TimeoutError:
+                raise IdleTimeout
+        length, msg_type, codec = unpack_header(header)
+        limit = frame_limit(msg_type, limits)
+        if limit == REJECTED:
+            raise UnexpectedFrame(msg_type)
+        if length > limit:
+            skipped = stream if codec == Codec.zstream else None
+            while length:
+                chunk = await reader.readexactly(min(length, READ_BUFFER_SIZE))
+                if skipped is not None:
+                    skipped.skip(chunk)
+                length -= len(chunk)
+            if skipped is not None:
+                skipped.skip_end()
+            raise FrameTooLarge(msg_type)
+        if timeout is None:
+            body = await reader.readexactly(length)
+        else:
+            body = await asyncio.wait_for(reader.readexactly(length), timeout)
+    except asyncio.IncompleteReadError:
+        if throw_empty:
+            raise Empty
+        else:
+            return MsgType.empty, b""
+    data = decode_frame(msg_type, codec, body, stream, limits)
+    if metrics is not None:
+        metrics.frame_in(msg_type, len(data), HEADER.size + length)
+    return msg_type, data
+
+
+async def write_frame(writer, data, msg_type=MsgType.none, compress=True, stream=None):
+    if stream is None:
+        writer.write(build_frame(data, msg_type, compress))
+    else:
+        writer.write(stream.build_frame(data, msg_type, compress))
+    await writer.drain()
+
+
+async def read_message(reader, throw_empty=True, encoding='utf8', stream=None):
+    msg_type, data = await read_frame(reader, throw_empty, stream)
+    return msg_type, data.decode(encoding)
+
+
+async def write_message(writer, msg, msg_type=MsgType.none, encoding='utf8', stream=None):
+    await write_frame(writer, msg.encode(encoding), msg_type, stream=stream)
+
+
+async def write_file_stream(writer, f):
+    for frame in file_frames(f):
+        writer.write(frame)
+        await writer.drain()
+
+
+async def read_file_stream(reader, f, on_other=None, on_range=None):
+    """Принимает файл в f из AsyncFrameReader; посторонние кадры (кроме error) передаются в on_other"""
+    receiver = FileReceiver(f, on_range)
+    while True:
+        msg_type, data = await reader.receive_byte_message()
+        if on_other and msg_type not in TRANSFER_TYPES:
+            on_other(msg_type, data)
+        elif receiver.feed(msg_type, data):
+            return receiver.size
+        elif receiver.raw_size:
+            async for chunk in reader.read_raw(receiver.raw_size):
+                receiver.write(chunk)
+            receiver.raw_size = 0
+
+
+class AsyncFrameReader:
+    """Состояние входящей стороны соединения для asyncio, аналог FrameReader"""
+
+    def __init__(self, reader, limits=FRAME_LIMITS, heartbeat=None):
+        self.reader = reader
+        self.limits = limits
+        self.stream = None
+        self.metrics = None
+        self.writer = None
+        self.heartbeat = heartbeat
+
+    def set_heartbeat(self, heartbeat):
+        self.heartbeat = heartbeat
+
+    async def read_raw(self, size):
+        if self.metrics is not None:
+            self.metrics.frame_in(MsgType.file_chunk, size, size)
+        timeout = self.heartbeat.read_timeout if self.heartbeat is not None else None
+        while size:
+            chunk = await asyncio.wait_for(self.reader.read(min(size, READ_BUFFER_SIZE)), timeout)
+            if not chunk:
+                raise Empty
+            yield chunk
+            size -= len(chunk)
+
+    async def receive_byte_message(self, throw_empty=True):
+        while True:
+            heartbeat = self.heartbeat
+            try:
+                frame = await read_frame(self.reader, throw_empty, self.stream, self.limits, self.metrics,
+                                         heartbeat.read_timeout if heartbeat is not None else None)
+            except IdleTimeout:
+                if heartbeat is None or heartbeat.expired(self.writer):
+                    raise TimeoutError('Connection timed out')
+                continue
+            if heartbeat is not None:
+                heartbeat.reset()
+            if not control_frame(self, *frame):
+                return frame
+
+    async def receive_message(self, throw_empty=True, encoding='utf8'):
+        msg_type, data = await self.receive_byte_message(throw_empty)
+        return msg_type, data.decode(encoding)
+
+
+class AsyncFrameWriter(FrameWriter):
+    """FrameWriter поверх asyncio.StreamWriter с ограниченной исходящей очередью,
+    которую разбирает отдельная задача. Вызовы из других потоков передаются в цикл событий.
+    Ждать в цикле событий нельзя, поэтому политика block здесь работает как disconnect"""
+
+    def __init__(self, writer, coalescer=None, max_bytes=OUTBOUND_QUEUE_BYTES,
+                 overflow=OVERFLOW_DISCONNECT, timeout=1.0):
+        super().__init__(writer.get_extra_info('socket'), coalescer)
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.get_ident()
+        self.queue = OutboundQueue(max_bytes, overflow)
+        self.timeout = timeout
+        self.closing = False
+        self.closed = False
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.done = asyncio.Event()
+        self.task = self.loop.create_task(self.run())
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def _send(self, raw):
+        self.writer.write(raw)
+
+    def _call(self, method, *args):
+        if threading.get_ident() == self.thread:
+            method(*args)
+        else:
+            self.loop.call_soon_threadsafe(method, *args)
+
+    def _put(self, size, droppable, method, *args):
+        if self.closing:
+            return
+        if not self.queue.fits(size):
+            if self.queue.overflow == OVERFLOW_DROP_OLDEST:
+                self.queue.drop_oldest(size)
+            else:
+                # Читающая сторона увидит закрытое соединение и удалит клиента
+                self._close_now(abort=True)
+                return
+        self.queue.push(size, droppable, method, args)
+        self.idle.clear()
+        self.ready.set()
+
+    async def run(self):
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self.idle.set()
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                method, args, queued = self.queue.pop()
+                result = method(*args)
+                if result is not None:
+                    await result  # Отправка файла — сопрограмма
+                await self.writer.drain()
+                self._sent(queued)
+        except OSError:
+            self._close_now(abort=True)
+
+    def write(self, raw):
+        # Части файла не выбрасываются: отправитель ждёт их ухода в drain
+        self._call(self._put, 0, False, super().write, raw)
+
+    def flush(self, cache=None):
+        self._call(self._put, 0, False, super().flush, cache)
+
+    def send_frame(self, frame):
+        self._call(self._put, len(frame.data), True, super().send_frame, frame)
+
+    def send_reply(self, frame):
+        self._call(self._put, len(frame.data), False, super().send_reply, frame)
+
+    def send_snapshot(self, snapshot):
+        self._call(self._put, 0, False, super().send_snapshot, snapshot)
+
+    def _switch_encoding(self, features):
+        self._call(self._put, 0, False, super()._switch_encoding, features)
+
+    def send_byte_message(self, data, msg_type=MsgType.none, compress=True):
+        self._call(self._put, len(data), False, super().send_byte_message, data, msg_type, compress)
+
+    def send_file(self, f, size, on_sent=None, offset=0):
+        self._call(self._put, 0, False, self._send_file, f, size, on_sent, offset)
+
+    async def _send_file(self, f, size, on_sent, offset):
+        with f:
+            super().flush()
+            await self.writer.drain()
+            if self.metrics is not None:
+                self.metrics.frame_out(MsgType.file_chunk, size, size)
+            # На Unix цикл событий отправляет файл через os.sendfile
+            if size:
+                await self.loop.sendfile(self.writer.transport, f, offset, size)
+        if on_sent is not None:
+            on_sent()
+
+    def close(self):
+        self._call(self._close)
+
+    def _close(self):
+        if self.closing:
+            return
+        self.closing = True
+        self.queue.push(0, False, self._close_now, ())
+        self.ready.set()
+        self.loop.call_later(self.timeout, self._close_now, True)
+
+    def _close_now(self, abort=False):
+        if self.closed:
+            return
+        self.closing = self.closed = True
+        if abort:
+            self.writer.transport.abort()
+        else:
+            self.writer.close()
+        self.ready.set()
+        self.idle.set()
+        self.done.set()
+
+    async def drain(self):
+        await self.idle.wait()
+        if self.closed:
+            raise ConnectionResetError('Connection is closed')
+
+    async def wait_closed(self):
+        await self.done.wait()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class AsyncCoalescer(Coalescer):
+    """Coalescer для asyncio: сброс по таймеру цикла событий вместо отдельного потока"""
+
+    def __init__(self, loop, window=0.002, max_bytes=16 * 1024):
+        self.loop = loop
+        self.window = window
+        self.max_bytes = max_bytes
+        self.dirty = set()
+        self.timer = None
+
+    def schedule(self, writer):
+        self.dirty.add(writer)
+        if self.timer is None:
+            self.timer = self.loop.call_later(self.window, self.flush)
+
+    def flush(self):
+        self.timer = None
+        writers, self.dirty = self.dirty, set()
+        self.flush_writers(writers)
@@ -0,0 +1,134 @@
+import bisect
+import collections
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы корзин гистограмм по умолчанию, в секундах
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+# Для скорости передачи файлов, в байтах в секунду
+THROUGHPUT_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6, 1e9)
+
+
+class Histogram:
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина — +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Счётчики и гистограммы сервера с выводом в текстовом формате Prometheus.
+    Метки задаются именованными аргументами, например inc('chat_messages_in_total', type='chatmsg')"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)  # (имя, метки) -> значение
+        self.histograms = {}                          # (имя, метки) -> Histogram
+        self.gauges = {}                              # имя -> функция без аргументов
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, func):
+        """Значение вычисляется в момент вывода"""
+        self.gauges[name] = func
+
+    # Вызываются на каждый кадр, поэтому все счётчики обновляются под одной блокировкой
+
+    def frame_in(self, msg_type, size, wire_size):
+        with self.lock:
+            self.counters['chat_messages_in_total', (('type', msg_type.name),)] += 1
+            self.counters['chat_bytes_in_total', (('stage', 'decoded'),)] += size
+            self.counters['chat_bytes_in_total', (('stage', 'wire'),)] += wire_size
+
+    def frame_out(self, msg_type, size, wire_size):
+        with self.lock:
+            self.counters['chat_messages_out_total', (('type', msg_type.name),)] += 1
+            self.counters['chat_bytes_out_total', (('stage', 'raw'),)] += size
+            self.counters['chat_bytes_out_total', (('stage', 'wire'),)] += wire_size
+
+    def send_latency(self, seconds):
+        self.observe('chat_send_latency_seconds', seconds)
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        for name, func in sorted(self.gauges.items()):
+            header(name, 'gauge')
+            lines.append(f'{name} {func()}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """HTTP-сервер с одной страницей /metrics; слушает только локальный адрес"""
+
+    daemon_threads = True
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        self.metrics = metrics
+        super().__init__((host, port), MetricsHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -5,7 +5,7 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QFont, QKeySequence
 
-from base_client import ThreadSafeChatClient, thread_safe
+from base_client import ThreadSafeChatClient, thread_safe, parse_client_args
 
 @thread_safe
 class GUIChatClient(ThreadSafeChatClient):
@@ -69,6 +69,11 @@ class GUIChatClient(ThreadSafeChatClient):
         download_file_action.setShortcut(QKeySequence('Ctrl+G'))
         self.menu_bar.addAction(download_file_action)
 
+        history_action = QAction("Older Messages", self.window)
+        history_action.triggered.connect(self._wrapper(self.request_history))
+        history_action.setShortcut(QKeySequence('Ctrl+H'))
+        self.menu_bar.addAction(history_action)
+
     def create_chat_interface(self):
         self.chat_label = QLabel("Chat:")
         self.layout.addWidget(self.chat_label)
@@ -134,4 +139,5 @@ class GUIChatClient(ThreadSafeChatClient):
         self.app.quit()
 
 if __name__ == "__main__":
-    client = GUIChatClient()
+    args = parse_client_args('Qt chat client')
+    client = GUIChatClient(args.host, args.port)
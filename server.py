@@ -4,206 +4,762 @@ import signal
 import sys
 import re
 import os
-from datetime import datetime
+import shutil
+import itertools
+import argparse
+import collections
+import secrets
+import time
 
 from message import *
+from storage import HistoryStore, FileStore, format_entry
+from server_log import ServerLog, LEVELS, DEBUG, INFO, WARNING, ERROR
+from metrics import Metrics, MetricsServer, THROUGHPUT_BUCKETS
 
-class User:
-    count = 0
-    users = {}
+HISTORY_PAGE_SIZE = 500
 
-    def __init__(self, name, sock):
+class User:
+    def __init__(self, user_id, name, sock, reader, writer):
+        self.id = user_id
         self.name = name
         self.sock = sock
-        self.id = User.count
-        User.count += 1
-        User.users[self.id] = self
+        self.reader = reader
+        self.writer = writer
+        self.history_seq = 0  # Номер первого сообщения, полученного при входе
+        self.channel_token = None  # Пароль для открытия каналов передачи файлов
+        self.channels = set()
 
     def __str__(self):
         return f"'{self.name}'"
 
-    @classmethod
-    def list(cls):
-        return User.users.values()
 
-    @classmethod
-    def names(cls):
-        return map(lambda x: x.name, User.list())
+class Channel(User):
+    """Второе соединение пользователя, по которому идут только его передачи файлов.
+    owner — User этого процесса; в кластере пользователь мог войти через другой рабочий процесс"""
+
+    def __init__(self, name, sock, reader, writer, owner=None):
+        super().__init__(None, name, sock, reader, writer)
+        self.owner = owner
+
+
+class UserRegistry:
+    """Подключённые пользователи с индексом по имени. Имя сначала резервируется
+    (проверка и захват под одной блокировкой), а после ответа клиенту занимается пользователем.
+    snapshot() возвращает неизменяемый кортеж, по которому можно рассылать без блокировки"""
+
+    def __init__(self, reserved=('admin',)):
+        self.lock = threading.Lock()
+        self.users = {}    # id -> User
+        self.by_name = {}  # имя -> User или None, если имя только зарезервировано
+        self.reserved = set(reserved)
+        self.count = 0
+        self.users_snapshot = ()
+
+    def __len__(self):
+        return len(self.users_snapshot)
+
+    def reserve(self, name):
+        with self.lock:
+            if name in self.by_name or name in self.reserved:
+                return False
+            self.by_name[name] = None
+            return True
+
+    def release(self, name):
+        with self.lock:
+            if name in self.by_name and self.by_name[name] is None:
+                del self.by_name[name]
+
+    def add(self, name, sock, reader, writer):
+        with self.lock:
+            user = User(self.count, name, sock, reader, writer)
+            self.count += 1
+            self.users[user.id] = user
+            self.by_name[name] = user
+            self.users_snapshot = tuple(self.users.values())
+            return user
+
+    def remove(self, user):
+        """Возвращает False, если пользователь уже удалён"""
+        with self.lock:
+            if self.users.get(user.id) is not user:
+                return False
+            del self.users[user.id]
+            del self.by_name[user.name]
+            self.users_snapshot = tuple(self.users.values())
+            return True
+
+    def get(self, user_id):
+        return self.users.get(user_id)
+
+    def get_by_name(self, name):
+        return self.by_name.get(name)
+
+    def snapshot(self):
+        return self.users_snapshot
+
+    def names(self):
+        return [user.name for user in self.users_snapshot]
+
+class History:
+    """Последние рассылки, ограниченные по числу и суммарному объёму. Новым пользователям
+    уходит один сжатый кадр batch, который собирается заново только после изменения истории"""
 
-    @classmethod
-    def get_user_by_id(cls, user_id):
-        return User.users.get(user_id)
+    def __init__(self, max_count=1000, max_bytes=1024 * 1024):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.entries = collections.deque()  # (seq, Frame)
+        self.size = 0
+        self.last_seq = 0
+        self.cached = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def first_seq(self):
+        """Номер самого старого сообщения в памяти; для пустой истории — следующего"""
+        return self.entries[0][0] if self.entries else self.last_seq + 1
+
+    def append(self, frame, seq=None):
+        self.last_seq = self.last_seq + 1 if seq is None else seq
+        self.entries.append((self.last_seq, frame))
+        self.size += len(frame.data)
+        while self.entries and (len(self.entries) > self.max_count or self.size > self.max_bytes):
+            self.size -= len(self.entries.popleft()[1].data)
+        self.cached = None
+
+    def snapshot(self):
+        if self.cached is None:
+            self.cached = BatchFrame(frame for _, frame in self.entries)
+        return self.cached
 
-    @classmethod
-    def remove_user(cls, user):
-        del User.users[user.id]
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5555):
+    def __init__(self, host='0.0.0.0', port=5555, coalesce_window=0.002, coalesce_bytes=16 * 1024,
+                 frame_limits=None, queue_bytes=OUTBOUND_QUEUE_BYTES, queue_policy=OVERFLOW_DISCONNECT,
+                 queue_timeout=1.0, history_count=1000, history_bytes=1024 * 1024,
+                 history_db='./history.db', reuse_port=False, backlog=socket.SOMAXCONN,
+                 socket_options=None, log_options=None, metrics_port=0, idle_timeout=60, read_timeout=30,
+                 files_directory='./files'):
+        # Буферы, заданные слушающему сокету до listen, наследуют принятые соединения
+        self.socket_options = socket_options or SocketOptions()
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        #self.server.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if reuse_port:
+            # Несколько рабочих процессов слушают один порт, соединения распределяет ядро
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket_options.apply(self.server)
         self.server.bind((host, port))
-        self.server.listen(5)
+        self.server.listen(backlog)
         
-        self.show_log = True
-        self.hidden_log = []
-        self.history = []
+        # Уровень, ограничение частоты и файл журнала — аргументы ServerLog
+        self.logger = ServerLog(**(log_options or {}))
+        self.metrics = self.create_metrics()
+        self.metrics_server = MetricsServer(self.metrics, metrics_port) if metrics_port else None
+        self.console = True  # Команды администратора из stdin
+        self.bus = None      # BusClient из cluster.py, если сервер — один из рабочих процессов
+        self.history = History(history_count, history_bytes)
+        # История на диске переживает перезапуск; в памяти остаются только последние сообщения
+        self.history_store = HistoryStore(history_db) if history_db else None
+        if self.history_store is not None:
+            for seq, frame in self.history_store.page(limit=history_count, max_bytes=history_bytes):
+                self.history.append(frame, seq)
+        self.users = UserRegistry()
+        # Добавление пользователя и рассылка упорядочены относительно истории,
+        # чтобы новый пользователь не получил сообщение дважды
+        self.history_lock = threading.Lock()
         
-        self.files_directory = './files'
-        os.makedirs(self.files_directory, exist_ok=True)
-        self.files = {}
-        self.files_count = 0
+        self.files_directory = files_directory
+        self.file_store = FileStore(self.files_directory)
+        self.filelist = None  # Закэшированный кадр со списком файлов
+        self.channel_tokens = {}  # токен -> User, которому он выдан
+
+        # Пределы размера входящих кадров поверх значений для запросов клиента из message.py
+        self.frame_limits = {**REQUEST_FRAME_LIMITS, **(frame_limits or {})}
+
+        self.features = {FEATURE_CODECS, FEATURE_FIELDS, FEATURE_ZSTREAM, FEATURE_PING, FEATURE_RAW_FILES,
+                         FEATURE_RESUME, FEATURE_CHANNEL}
+        # Молчащему клиенту через idle_timeout секунд уходит ping, без ответа за read_timeout
+        # он отключается. Вход в чат должен уложиться в idle_timeout + read_timeout
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        # Рассылки копятся до coalesce_window секунд или coalesce_bytes байт и уходят одним кадром.
+        # Сам Coalescer создаётся в start(), так как зависит от режима работы сервера
+        self.coalesce_window = coalesce_window
+        self.coalesce_bytes = coalesce_bytes
+        self.coalescer = None
+        if coalesce_window:
+            self.features.add(FEATURE_BATCH)
+
+        # Исходящая очередь каждого клиента: объём, политика при переполнении и таймаут для block
+        if queue_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy: {queue_policy}')
+        self.queue_bytes = queue_bytes
+        self.queue_policy = queue_policy
+        self.queue_timeout = queue_timeout
         
         signal.signal(signal.SIGINT, self.shutdown)
         self.log(f"Server started on port {port}")
 
-    def log(self, text, must_show=False):
-        text = f'{datetime.now().strftime("%H:%M:%S")}    {text}'
-        if must_show or self.show_log:
-            print(text)
-        else:
-            self.hidden_log.append(text)
-    
-    def show_hidden_log(self):
-        for msg in self.hidden_log:
-            print(msg)
+    def create_metrics(self):
+        metrics = Metrics()
+        metrics.describe('chat_connections_total', 'Accepted client connections')
+        metrics.describe('chat_messages_in_total', 'Frames received, by message type')
+        metrics.describe('chat_messages_out_total', 'Frames sent, by message type')
+        metrics.describe('chat_bytes_in_total', 'Bytes received on the wire and after decompression')
+        metrics.describe('chat_bytes_out_total', 'Bytes sent before compression and on the wire')
+        metrics.describe('chat_broadcast_seconds', 'Time to hand one broadcast to every local user')
+        metrics.describe('chat_send_latency_seconds', 'Time an item waits in a user outbound queue')
+        metrics.describe('chat_file_bytes_total', 'File transfer volume')
+        metrics.describe('chat_file_transfer_seconds', 'File transfer duration')
+        metrics.describe('chat_file_throughput_bytes_per_second', 'File transfer speed')
+        metrics.describe('chat_timeouts_total', 'Connections dropped after a read or ping timeout')
+        metrics.gauge('chat_users', lambda: len(self.users))
+        metrics.gauge('chat_threads', threading.active_count)
+        metrics.gauge('chat_history_messages', lambda: len(self.history))
+        metrics.gauge('chat_history_bytes', lambda: self.history.size)
+        metrics.gauge('chat_outbound_queue_items', lambda: sum(u.writer.depth for u in self.users.snapshot()))
+        return metrics
+
+    def attach_metrics(self, reader, writer):
+        self.metrics.inc('chat_connections_total')
+        reader.metrics = self.metrics
+        writer.metrics = self.metrics
+
+    def count_transfer(self, direction, size, started):
+        seconds = time.monotonic() - started
+        self.metrics.inc('chat_file_bytes_total', size, direction=direction)
+        self.metrics.observe('chat_file_transfer_seconds', seconds, direction=direction)
+        if seconds > 0:
+            self.metrics.observe('chat_file_throughput_bytes_per_second', size / seconds,
+                                 buckets=THROUGHPUT_BUCKETS, direction=direction)
+
+    def new_heartbeat(self):
+        return Heartbeat(self.idle_timeout, self.read_timeout) if self.idle_timeout else None
+
+    def login_done(self, reader):
+        if reader.writer is None:
+            # Старый клиент не отвечает на ping: его молчание нормально, обрыв заметит keepalive TCP
+            reader.set_heartbeat(None)
+
+    def log(self, text, must_show=False, level=INFO, limited=False):
+        """limited — строки на каждое сообщение, их частота ограничивается"""
+        self.logger.log(text, level, must_show, limited)
 
     def broadcast(self, message, msg_type=MsgType.chatmsg, inbytes=False):
-        self.history.append((message, msg_type))
+        # Кадр собирается один раз и рассылается всем без повторного сжатия
+        if inbytes:
+            frame = Frame(message, msg_type)
+        else:
+            frame = Frame.from_message(message, msg_type)
+        if self.bus is not None:
+            # Рассылку получат все процессы, включая этот, в общем порядке
+            self.bus.broadcast(frame)
+        else:
+            self.deliver(frame)
+        self.log(f'Sent message "{message}" ({msg_type.name})', level=DEBUG, limited=True)
+
+    def deliver(self, frame, seq=None):
+        """Добавляет кадр в историю и отправляет его пользователям этого процесса"""
+        with self.history_lock:
+            if seq is None and self.history_store is not None:
+                seq = self.history_store.append(frame)
+            self.history.append(frame, seq)
+            users = self.users.snapshot()
 
-        for user in User.list():
+        started = time.monotonic()
+        for user in users:
             try:
-                if inbytes:
-                    send_byte_message(user.sock, message, msg_type)
-                else:
-                    send_message(user.sock, message, msg_type)
-                    
+                user.writer.send_frame(frame)
                 # self.log(f'Sent message "{message}" ({msg_type.name}) to {user}')
             except Exception as e:
-                self.log(f'Error broadcasting to {user}: {e}')
+                self.log(f'Error broadcasting to {user}: {e}', level=WARNING)
                 self.remove_client(user)
-
-        self.log(f'Sent message "{message}" ({msg_type.name})')
+        self.metrics.observe('chat_broadcast_seconds', time.monotonic() - started)
 
     def remove_client(self, user, banned=False):
-        if user.id in User.users:
+        if self.users.remove(user):
             if not banned:
                 msg = f'{user} has left the chat'
             else:
                 msg = f'{user} was banned'
 
-            user.sock.close()
-            User.remove_user(user)
+            if self.bus is not None:
+                self.bus.offline(user.name)
+            self.channel_tokens.pop(user.channel_token, None)
+            for channel in list(user.channels):
+                channel.writer.close()
+            user.writer.close()
             self.broadcast(msg, MsgType.special)
             self.log(f'{user} removed')
 
+    def ban_user(self, user):
+        user.writer.send_message("", MsgType.ban)
+        self.remove_client(user, banned=True)
+
+    def kill_user(self, username):
+        user = self.users.get_by_name(username)
+        if user is not None:
+            self.ban_user(user)
+
+    def send_private(self, username, text):
+        """Сообщение администратора одному пользователю; False, если его нет в этом процессе"""
+        user = self.users.get_by_name(username)
+        if user is None:
+            return False
+        user.writer.send_byte_message(encode_fields('admin (only for you)', text), MsgType.chatmsg)
+        return True
+
+    def print_users(self):
+        """Вывести пользователей процесса с длиной очереди и задержкой отправки"""
+        for user in self.users.snapshot():
+            writer = user.writer
+            line = f'{user.id}: {user} (queue: {writer.depth}'
+            if writer.latency_count:
+                average = writer.latency_sum / writer.latency_count
+                line += f', send latency avg {average * 1000:.1f} ms, max {writer.latency_max * 1000:.1f} ms'
+            print(line + ')')
+
+    def add_user(self, username, sock, reader, writer):
+        with self.history_lock:
+            user = self.users.add(username, sock, reader, writer)
+            user.history_seq = self.history.first_seq
+            user.writer.send_snapshot(self.history.snapshot())
+        if self.bus is not None:
+            self.bus.online(username)
+        self.log(f'New user added: {user}')
+        self.broadcast(f'{user} has joined the chat!', MsgType.special)
+        if FEATURE_CHANNEL in writer.features:
+            self.issue_channel_token(user)
+        return user
+
+    def issue_channel_token(self, user):
+        user.channel_token = secrets.token_hex(16)
+        self.channel_tokens[user.channel_token] = user
+        if self.bus is not None:
+            self.bus.channel_token(user.channel_token, user.name)
+        user.writer.send_message(user.channel_token, MsgType.channel)
+
+    def open_channel(self, token, reader, writer):
+        """Канал передачи файлов для пользователя с этим токеном; None, если токен неизвестен"""
+        owner = self.channel_tokens.get(token)
+        if owner is not None:
+            name = owner.name
+        elif self.bus is not None:
+            # Второе соединение могло достаться другому рабочему процессу
+            name = self.bus.channel_owner(token)
+        else:
+            name = None
+        if name is None:
+            self.log('Rejected file channel with unknown token', level=WARNING)
+            return None
+        writer.send_message('0', MsgType.channel)
+        channel = Channel(name, writer.sock, reader, writer, owner)
+        if owner is not None:
+            # Канал закрывается вместе с основным соединением
+            owner.channels.add(channel)
+        # Ping по каналу не ходит, поэтому своего таймаута ему не нужно: пользователь может
+        # сколько угодно выбирать файл в диалоге, а клиент закрывает канал при выходе.
+        # Это касается и канала, основное соединение которого держит другой рабочий процесс
+        reader.set_heartbeat(None)
+        self.log(f'Opened file channel for {channel}', level=DEBUG)
+        return channel
+
+    def close_channel(self, channel, e):
+        if not isinstance(e, Empty):
+            self.log(f'File channel of {channel} closed: {e}', level=WARNING)
+        if channel.owner is not None:
+            channel.owner.channels.discard(channel)
+        channel.writer.close()
+
+    def handle_message(self, user, msg_type, message):
+        """Сообщения, ответ на которые не требует дальнейшего чтения из соединения"""
+        if msg_type == MsgType.chatmsg:
+            if message:
+                self.broadcast(encode_fields(user.name, message), inbytes=True)
+        elif msg_type == MsgType.usersinfo:
+            answer = encode_fields(*self.online_names())
+            user.writer.send_byte_message(answer, MsgType.usersinfo)
+        elif msg_type == MsgType.history:
+            self.send_history_page(user, message)
+        else:
+            self.log('Error: Message of unknown type', level=WARNING)
+
+    def send_history_page(self, user, request):
+        """Запрос: "count [seq|@time]". Сообщения старше курсора уходят одним batch,
+        за ним кадр history с курсором для следующей страницы ('0', если старше ничего нет)"""
+        try:
+            count, *cursor = request.split()
+            count = min(int(count), HISTORY_PAGE_SIZE)
+            if not cursor:
+                before = user.history_seq
+            elif cursor[0].startswith('@'):
+                before = self.seq_at(float(cursor[0][1:]))
+            else:
+                before = int(cursor[0])
+        except ValueError:
+            user.writer.send_message('Invalid history request', MsgType.error)
+            return
+
+        page = []
+        if self.history_store is not None and before and count > 0:
+            page = self.history_store.page(before, count)
+        user.writer.send_snapshot(BatchFrame(frame for _, frame in page))
+        user.writer.send_message(str(page[0][0]) if page else '0', MsgType.history)
+
+    def seq_at(self, timestamp):
+        if self.history_store is None:
+            return 0
+        seq = self.history_store.seq_at(timestamp)
+        return self.history.last_seq + 1 if seq is None else seq
+
+    def handle_error(self, user, e):
+        """Возвращает True, если обслуживание клиента можно продолжать"""
+        if isinstance(e, FrameTooLarge):
+            self.log(f'Rejected message from {user}: {e}', level=WARNING)
+            user.writer.send_message(str(e), MsgType.error)
+            return True
+        if isinstance(e, Empty):
+            self.log(f'Connection with "{user}" lost')
+        elif isinstance(e, UnexpectedFrame):
+            self.log(f'Disconnecting {user}: {e}', level=WARNING)
+        elif isinstance(e, TimeoutError):
+            self.metrics.inc('chat_timeouts_total')
+            self.log(f'Connection with "{user}" timed out')
+        else:
+            self.log(f'Catched exception while handling user "{user}": {e}', level=ERROR)
+        self.remove_client(user)
+        return False
+
     def handle_client(self, client_socket):
-        username = self.set_username(client_socket)
+        self.socket_options.apply(client_socket)
+        reader = FrameReader(client_socket, limits=self.frame_limits, heartbeat=self.new_heartbeat())
+        writer = QueuedFrameWriter(client_socket, self.coalescer, self.queue_bytes,
+                                   self.queue_policy, self.queue_timeout)
+        self.attach_metrics(reader, writer)
+        try:
+            username = self.set_username(reader, writer)
+        except OSError as e:
+            self.log(f'Login failed: {e}')
+            username = None
+        except Exception as e:
+            # Неизвестный тип кадра или имя не в UTF-8: соединение всё равно нужно закрыть
+            self.log(f'Malformed login: {e!r}', level=WARNING)
+            username = None
         if username is None:
             self.log('New user not added')
-            client_socket.close()
+            writer.close()
+            return
+        if isinstance(username, Channel):
+            self.serve_channel(username)
             return
         
-        
-        user = User(username, client_socket)
-        self.log(f'New user added: {user}')
-        for msg, msg_type in self.history:
-            send_message(user.sock, msg, msg_type)
-        self.broadcast(f'{user} has joined the chat!', MsgType.special)
-        
+        self.login_done(reader)
+        user = self.add_user(username, client_socket, reader, writer)
 
         while True:
             try:
-                msg_type, message = receive_message(user.sock)
-                self.log(f'Received message "{message}" ({msg_type.name}) from {user}')
-                if msg_type == MsgType.chatmsg:
-                    if message:
-                        self.broadcast(f'{user.name}\0{message}')
-                elif msg_type == MsgType.usersinfo:
-                    answer = "\0".join(User.names())
-                    send_message(user.sock, answer, MsgType.usersinfo)
-                elif msg_type == MsgType.put_file:
-                    self.receive_file(user, message)
-                elif msg_type == MsgType.get_file:
-                    self.send_filelist(user)
-                    _, fileid = receive_message(user.sock)
-                    if not fileid:
-                        self.log('Stopped file sending procedure')
-                        continue
-                    self.send_file(user, fileid)
-                else:
-                    self.log('Error: Message of unknown type')
-            except Empty:
-                self.log(f'Connection with "{user}" lost')
-                self.remove_client(user)
-                break
+                msg_type, message = user.reader.receive_message()
+                self.log(f'Received message "{message}" ({msg_type.name}) from {user}',
+                         level=DEBUG, limited=True)
+                if not self.handle_transfer(user, msg_type, message):
+                    self.handle_message(user, msg_type, message)
             except Exception as e:
-                self.log(f'Catched exception while handling user "{user}": {e}')
-                self.remove_client(user)
+                if not self.handle_error(user, e):
+                    break
+
+    def handle_transfer(self, user, msg_type, message):
+        """Обрабатывает put_file и get_file; для остальных сообщений возвращает False"""
+        if msg_type == MsgType.put_file:
+            self.receive_file(user, message)
+        elif msg_type == MsgType.get_file:
+            self.send_filelist(user)
+            _, request = user.reader.receive_message()
+            if not request:
+                self.log('Stopped file sending procedure')
+            else:
+                self.send_file(user, request)
+        else:
+            return False
+        return True
+
+    def serve_channel(self, channel):
+        while True:
+            try:
+                msg_type, message = channel.reader.receive_message()
+                if not self.handle_transfer(channel, msg_type, message):
+                    raise TransferError(f'Unexpected message of type {msg_type.name}')
+            except Exception as e:
+                self.close_channel(channel, e)
                 break
     
-    def receive_file(self, user, filename):
-        t, data = receive_byte_message(user.sock)
-        if t == MsgType.error:
-            self.log('Stopped file getting procedure')
+    def receive_file(self, user, request):
+        try:
+            filename, upload, expected = self.start_upload(user, request)
+        except (OSError, ValueError) as e:
+            self.reject_upload(user, e)
             return
+        if upload is None:
+            self.finish_upload(user, filename, digest=expected[2])
+            return
+        started = time.monotonic()
         try:
-            fileid = self.add_file(filename, data)
-        except OSError:
-            send_message(user.sock, "Your file was not saved", MsgType.error)
+            with upload:
+                size = 0
+                # Докачиваемый файл может быть уже принят целиком, тогда клиент ничего не шлёт
+                if expected is None or expected[0] < expected[1]:
+                    size = receive_file_stream(user.reader, upload, on_range=self.range_check(upload, expected))
+            self.check_upload(upload, expected)
+        except (TransferError, FrameTooLarge, OSError, ValueError, Empty) as e:
+            self.discard_upload(user, upload, e)
         else:
-            self.broadcast(f'{user} uploaded file "{filename}" ({fileid})', MsgType.special)
-    
-    def add_file(self, filename, data):
-        fileid = str(self.files_count)
-        with open(f'{self.files_directory}/id{fileid}', 'wb') as f:
-            f.write(data)
-            
-        self.files[fileid] = filename
-        self.files_count += 1
-        
-        return fileid
+            self.count_transfer('in', size, started)
+            self.finish_upload(user, filename, upload)
+
+    def start_upload(self, user, request):
+        """Разбирает запрос put_file: (имя, Upload, (смещение, размер, хеш) или None).
+        Клиент с докачкой присылает "хеш размер имя" и получает в ответ смещение,
+        с которого слать файл; Upload None, если такое содержимое уже хранится"""
+        if FEATURE_RESUME not in user.writer.features:
+            return request, self.file_store.upload(), None
+        digest, size, filename = request.split(' ', 2)
+        size = int(size)
+        if not re.fullmatch('[0-9a-f]{64}', digest) or size < 0:
+            raise ValueError(f'Bad upload request: {request}')
+        upload, offset = self.file_store.resume(digest, size)
+        if upload is not None and offset:
+            self.log(f'Resuming upload of "{filename}" from {user} at {offset} of {size} bytes')
+        user.writer.send_message(str(offset), MsgType.put_file)
+        return filename, upload, (offset, size, digest)
+
+    def reject_upload(self, user, e):
+        # Клиент с докачкой ждёт ответа на запрос и ничего не прислал, читать дальше можно
+        self.log(f'Rejected upload from {user}: {e}', level=WARNING)
+        user.writer.send_message("Your file was not saved", MsgType.error)
+
+    def range_check(self, upload, expected):
+        if expected is None:
+            return None
+
+        def on_range(offset, total, digest):
+            if (offset, total, digest) != expected:
+                raise TransferError('Unexpected file range')
+            return upload
+        return on_range
+
+    def check_upload(self, upload, expected):
+        if expected is not None and upload.hash.hexdigest() != expected[2]:
+            raise ValueError('File hash mismatch')
+
+    def discard_upload(self, user, upload, e):
+        self.log(f'Stopped file getting procedure: {e}')
+        if upload.key is not None and isinstance(e, (Empty, ConnectionError, TimeoutError)):
+            # Принятое остаётся на диске, клиент докачает файл после переподключения
+            self.file_store.suspend(upload)
+        else:
+            self.file_store.discard(upload)
+        if isinstance(e, (Empty, TimeoutError)):
+            # Соединение закрыто или кадр оборвался на середине, дальше читать нельзя
+            raise e
+        # Если отправитель сам прервал передачу, сообщать ему об этом не нужно
+        if not isinstance(e, TransferError):
+            user.writer.send_message("Your file was not saved", MsgType.error)
+
+    def finish_upload(self, user, filename, upload=None, digest=None):
+        """Публикует принятый файл, без upload — новую ссылку на хранящееся содержимое digest"""
+        fileid = self.new_fileid()
+        if upload is None:
+            if not self.link_file(fileid, filename, digest, user.name):
+                user.writer.send_message("Your file was not saved", MsgType.error)
+                return
+            self.log(f'File #{fileid} is already stored, nothing to receive')
+        elif self.publish_file(fileid, filename, upload, user.name):
+            self.log(f'File #{fileid} has the same content as an already stored file')
+        self.broadcast(f'{user} uploaded file "{filename}" ({fileid})', MsgType.special)
+
+    def new_fileid(self):
+        if self.bus is not None:
+            return self.bus.new_fileid()
+        return self.file_store.new_id()
+
+    def publish_file(self, fileid, filename, upload, uploader):
+        """Переносит принятый файл в хранилище и делает его доступным во всех процессах.
+        Возвращает True, если такое содержимое уже хранилось"""
+        if self.bus is not None:
+            def store(path, digest, checksum):
+                return self.bus.commit_file(fileid, filename, path, digest, uploader, checksum)
+            digest, duplicate = self.file_store.commit(upload, store=store)
+        else:
+            digest, duplicate = self.file_store.commit(upload, fileid, filename, uploader)
+            self.filelist = None
+        return duplicate
+
+    def link_file(self, fileid, filename, digest, uploader):
+        if self.bus is not None:
+            return self.bus.commit_file(fileid, filename, None, digest, uploader, None) is not None
+        self.filelist = None
+        return self.file_store.link(digest, fileid, filename, uploader)
+
+    def add_file(self, fileid, filename, digest):
+        self.file_store.add(fileid, filename, digest)
+        self.filelist = None
+
+    def remove_file(self, fileid):
+        # Blob без ссылок удаляет владелец списка файлов: сам сервер или хаб кластера
+        filename = self.file_store.remove(fileid, unlink=self.bus is None)
+        self.filelist = None
+        return filename
     
     def send_filelist(self, user):
-        msg = "\0".join(f'{i}\0{f}' for i, f in self.files.items())
-        send_message(user.sock, msg, MsgType.get_file)
-        self.log(f'Filelist: {repr(msg)}')
-        self.log(f'Sent file list to {user}')
+        if self.filelist is None:
+            self.filelist = Frame(encode_fields(*itertools.chain.from_iterable(self.file_store.items())),
+                                  MsgType.get_file)
+        user.writer.send_reply(self.filelist)
+        self.log(f'Sent file list to {user}', level=DEBUG)
     
-    def send_file(self, user, fileid):
+    def open_stored_file(self, user, fileid):
+        """Возвращает (файл, хеш содержимого); если открыть нельзя, сообщает клиенту об ошибке"""
         self.log(f'{user} asks to get file #{fileid}')
-        if fileid in self.files:
-            try:
-                with open(f'{self.files_directory}/id{fileid}', 'rb') as f:
-                    data = f.read()
-                    send_byte_message(user.sock, data)
-                    self.log(f'Sent file #{fileid} to "{user}"')
-            except IOError:
-                send_byte_message(user.sock, b'', MsgType.error)
+        try:
+            return self.file_store.open(fileid)
+        except (KeyError, IOError):
+            pass
+        user.writer.send_byte_message(b'', MsgType.error)
+        return None, None
+
+    def file_range(self, f, digest, file_range):
+        """Часть файла для запроса "id смещение длина [хеш]": (смещение, длина, размер, crc32).
+        Нулевая длина — до конца файла. Если у клиента начало другого содержимого
+        (хеш не совпал), файл передаётся с начала"""
+        offset, length, *client_digest = file_range
+        offset = int(offset)
+        length = int(length)
+        if offset < 0 or length < 0:
+            raise ValueError(f'Bad file range: {offset} {length}')
+        size, crc = self.file_store.checksum(digest, f)
+        if client_digest and client_digest[0] != digest:
+            offset = 0
+        offset = min(offset, size)
+        length = min(length, size - offset) if length else size - offset
+        if length != size:
+            _, crc = file_checksum(f, offset, length)
+        return offset, length, size, crc
+
+    def send_file_raw(self, user, fileid, f, digest, transfer, ranged, started):
+        """Содержимое уходит через sendfile без сжатия и копирования; f закроет писатель"""
+        offset, length, size, crc = transfer
+        heartbeat = user.reader.heartbeat
+        if heartbeat is not None:
+            # Обработчик сразу возвращается к чтению, пока файл ещё стоит в очереди или отправляется
+            heartbeat.hold()
+
+        def on_sent():
+            if heartbeat is not None:
+                heartbeat.release()
+            self.count_transfer('out', length, started)
+        if ranged:
+            send_file_range(user.writer, f, offset, length, size, digest, crc, on_sent)
+            self.log(f'Sending bytes {offset}-{offset + length} of file #{fileid} to "{user}"')
         else:
-            send_byte_message(user.sock, b'', MsgType.error)
+            send_file_raw(user.writer, f, length, crc, on_sent)
+            self.log(f'Sending file #{fileid} to "{user}" with sendfile')
+
+    def send_file(self, user, request):
+        # Клиент с докачкой добавляет к id смещение, длину и хеш уже принятого начала
+        fileid, *file_range = request.split()
+        f, digest = self.open_stored_file(user, fileid)
+        if f is None:
+            return
+        started = time.monotonic()
+        if file_range or FEATURE_RAW_FILES in user.writer.features:
+            try:
+                transfer = self.file_range(f, digest, file_range or (0, 0))
+            except (IOError, ValueError) as e:
+                f.close()
+                self.log(f'Error sending file #{fileid}: {e}', level=WARNING)
+                user.writer.send_byte_message(b'', MsgType.error)
+                return
+            self.send_file_raw(user, fileid, f, digest, transfer, bool(file_range), started)
+            return
+        with f:
+            try:
+                send_file_stream(user.writer, f)
+            except IOError as e:
+                self.log(f'Error sending file #{fileid}: {e}', level=WARNING)
+                user.writer.send_byte_message(b'', MsgType.error)
+                return
+            self.count_transfer('out', f.tell(), started)
+        self.log(f'Sent file #{fileid} to "{user}"')
 
     def check_username(self, username):
         pattern = r'^[a-zA-Z0-9_-]+$'
         return 1 <= len(username) <= 30 and re.match(pattern, username) is not None
 
-    def set_username(self, client_socket):
+    def username_reply(self, username):
+        if not self.check_username(username):
+            return '2'
+        elif not self.reserve_name(username):
+            return '1'
+        return '0'
+
+    def reserve_name(self, username):
+        if not self.users.reserve(username):
+            return False
+        # Имя должно быть свободно во всех процессах, занимает его общий реестр
+        if self.bus is not None and not self.bus.reserve(username):
+            self.users.release(username)
+            return False
+        return True
+
+    def release_name(self, username):
+        self.users.release(username)
+        if self.bus is not None:
+            self.bus.release(username)
+
+    def online_names(self):
+        if self.bus is not None:
+            return self.bus.names()
+        return self.users.names()
+
+    def set_username(self, reader, writer):
+        """Имя вошедшего пользователя, Channel для канала передачи файлов или None"""
         while True:
-            t, username = receive_message(client_socket, throw_empty=False)
+            try:
+                t, username = reader.receive_message(throw_empty=False)
+            except FrameTooLarge as e:
+                writer.send_message(str(e), MsgType.error)
+                continue
+            if t == MsgType.hello:
+                self.accept_features(reader, writer, username.split())
+                continue
+            if t == MsgType.channel:
+                return self.open_channel(username, reader, writer)
             if t == MsgType.empty or not username:
-                client_socket.close()
                 return None
-            elif not self.check_username(username):
-                send_message(client_socket, '2')
-            elif username in User.names() or username == 'admin':
-                send_message(client_socket, '1')
-            else:
-                send_message(client_socket, '0')
+            reply = self.username_reply(username)
+            try:
+                writer.send_message(reply)
+            except Exception:
+                if reply == '0':
+                    self.release_name(username)
+                raise
+            if reply == '0':
                 return username
 
+    def accept_features(self, reader, writer, offered):
+        features = self.features.intersection(offered)
+        if FEATURE_FIELDS not in features:
+            # В batch рассылки вложены как есть, с полями нового формата
+            features.discard(FEATURE_BATCH)
+        writer.send_message(' '.join(sorted(features)), MsgType.hello)
+        apply_features(reader, writer, features)
+
     def start(self):
-        threading.Thread(target=self.exec_commands, daemon=True).start()
+        if self.coalesce_window:
+            self.coalescer = Coalescer(self.coalesce_window, self.coalesce_bytes)
+        if self.console:
+            threading.Thread(target=self.exec_commands, daemon=True).start()
         while True:
             try:
                 client_socket, addr = self.server.accept()
@@ -224,27 +780,24 @@ class ChatServer:
 
                 if cmd == 'send':
                     text = input('Message: ')
-                    self.broadcast(f'admin\0{text}')
+                    self.broadcast(encode_fields('admin', text), inbytes=True)
 
                 elif cmd == 'sendto' and args:
                     user_id = int(args[0])
-                    user = User.get_user_by_id(user_id)
+                    user = self.users.get(user_id)
                     if user:
-                        text = input('Message: ')
-                        send_message(user.sock, f'admin (only for you)\0{text}', MsgType.chatmsg)
+                        self.send_private(user.name, input('Message: '))
                     else:
                         print(f'User with id {user_id} does not exist')
 
                 elif cmd == 'users':
-                    for user in User.list():
-                        print(f'{user.id}: {user}')
+                    self.print_users()
 
                 elif cmd == 'kill' and args:
                     user_id = int(args[0])
-                    user = User.get_user_by_id(user_id)
+                    user = self.users.get(user_id)
                     if user:
-                        send_message(user.sock, "", MsgType.ban)
-                        self.remove_client(user, banned=True)
+                        self.ban_user(user)
                     else:
                         print(f'User with id {user_id} does not exist')
 
@@ -255,31 +808,35 @@ class ChatServer:
                         os.system('cls')
 
                 elif cmd == 'log':
-                    if self.show_log:
-                        self.show_log = False
-                    else:
-                        self.show_log = True
-                        self.show_hidden_log()
+                    self.logger.toggle()
                         
+                elif cmd == 'stats':
+                    print(self.metrics.render(), end='')
+
                 elif cmd == 'files':
-                    for i, file in self.files.items():
-                        print(f'{i}: {file}')
+                    for entry in self.file_store.entries():
+                        print(format_entry(entry))
                 
                 elif cmd == 'load':
                     filename = input('Enter filename: ')
-                    with open(filename, "rb") as f:
-                        data = f.read()
-                    
-                    self.add_file(os.path.basename(filename), data)
+                    upload = self.file_store.upload()
+                    try:
+                        with open(filename, 'rb') as src, upload:
+                            shutil.copyfileobj(src, upload)
+                    except OSError:
+                        self.file_store.discard(upload)
+                        raise
+                    fileid = self.new_fileid()
+                    self.publish_file(fileid, os.path.basename(filename), upload, 'admin')
                     self.broadcast(f'admin sent file "{filename}"', MsgType.special)
                     
                 elif cmd == 'rm' and args:
                     fileid = args[0]
-                    if fileid not in self.files:
+                    filename = self.remove_file(fileid)
+                    if filename is None:
                         print(f'File with id {fileid} does not exist')
-                    os.remove(f'{self.files_directory}/id{fileid}')
+                        continue
                     self.log(f'File #{fileid} was removed')
-                    filename = self.files.pop(fileid)
                     self.broadcast(f'File "{filename}" ({fileid}) was removed', MsgType.special)
                     
 
@@ -287,21 +844,85 @@ class ChatServer:
                     print('Unknown command')
 
             except Exception as e:
-                self.log(f'Exception in exec_commands(): {e}')
+                self.log(f'Exception in exec_commands(): {e}', level=ERROR)
                 continue
 
-    def shutdown(self, signum, frame):
-        self.log("Shutting down server...")
-        for user in list(User.list()):
+    def disconnect_all(self):
+        for user in self.users.snapshot():
             try:
-                send_message(user.sock, "", MsgType.srv_shutdown)
-                user.sock.close()
+                user.writer.send_message("", MsgType.srv_shutdown)
+                user.writer.close()
             except Exception as e:
-                self.log(f'Error shutting down user {user}: {e}')
+                self.log(f'Error shutting down user {user}: {e}', level=WARNING)
                 continue
+
+    def shutdown(self, signum, frame):
+        self.log("Shutting down server...")
+        users = self.users.snapshot()
+        self.disconnect_all()
+        # Ждём, пока писатели отправят srv_shutdown
+        for user in users:
+            user.writer.wait_closed()
         self.server.close()
+        self.logger.close()
         sys.exit(0)
 
 if __name__ == "__main__":
-    server = ChatServer()
+    parser = argparse.ArgumentParser(description='Chat server')
+    parser.add_argument('--mode', choices=('threads', 'asyncio'), default='threads',
+                        help='threads: a thread per client; asyncio: one event loop for all clients')
+    parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument('--port', type=int, default=5555, help='port to listen on')
+    parser.add_argument('--backlog', type=int, default=socket.SOMAXCONN,
+                        help='length of the queue of connections waiting for accept')
+    SocketOptions.add_arguments(parser)
+    Heartbeat.add_arguments(parser, idle_timeout=60, read_timeout=30)
+    parser.add_argument('--log-level', choices=LEVELS, default='info',
+                        help='debug also shows a line for every message')
+    parser.add_argument('--log-rate', type=int, default=100,
+                        help='limit for per-message log lines, per second (0 for no limit)')
+    parser.add_argument('--log-file', help='also write the log to this file, rotating it by size; '
+                        'with --workers, worker N writes to FILE.N')
+    parser.add_argument('--log-file-bytes', type=int, default=10 * 1024 * 1024,
+                        help='size of the log file before rotation')
+    parser.add_argument('--log-file-count', type=int, default=3, help='how many rotated log files to keep')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='serve metrics for Prometheus on 127.0.0.1:PORT/metrics '
+                             '(worker N of a cluster uses PORT + N)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes sharing the port via SO_REUSEPORT')
+    parser.add_argument('--queue-bytes', type=int, default=OUTBOUND_QUEUE_BYTES,
+                        help='outbound queue limit per client, in bytes')
+    parser.add_argument('--queue-policy', choices=OVERFLOW_POLICIES, default=OVERFLOW_DISCONNECT,
+                        help='what to do when a client queue is full')
+    parser.add_argument('--queue-timeout', type=float, default=1.0,
+                        help='how long the block policy waits for free space, in seconds')
+    parser.add_argument('--history-count', type=int, default=1000,
+                        help='how many recent messages new users receive')
+    parser.add_argument('--history-bytes', type=int, default=1024 * 1024,
+                        help='size limit of the history, in bytes')
+    parser.add_argument('--history-db', default='./history.db',
+                        help='SQLite file with the full chat history, empty to keep history in memory only')
+    parser.add_argument('--files-dir', default='./files',
+                        help='directory with uploaded files and their index, shared by cluster workers')
+    args = parser.parse_args()
+
+    options = dict(host=args.host, port=args.port, backlog=args.backlog,
+                   socket_options=SocketOptions.from_args(args), queue_bytes=args.queue_bytes,
+                   queue_policy=args.queue_policy, queue_timeout=args.queue_timeout,
+                   history_count=args.history_count, history_bytes=args.history_bytes,
+                   history_db=args.history_db, files_directory=args.files_dir,
+                   log_options=dict(level=LEVELS[args.log_level], rate=args.log_rate, path=args.log_file,
+                                    file_bytes=args.log_file_bytes, file_count=args.log_file_count),
+                   metrics_port=args.metrics_port, idle_timeout=args.idle_timeout,
+                   read_timeout=args.read_timeout)
+    if args.workers > 1:
+        from cluster import run_cluster
+        run_cluster(args.workers, args.mode, options)
+        sys.exit(0)  # Хаб завершает процесс сам, из serve() не возвращаются
+    elif args.mode == 'asyncio':
+        from async_server import AsyncChatServer
+        server = AsyncChatServer(**options)
+    else:
+        server = ChatServer(**options)
     server.start()
@@ -0,0 +1,137 @@
+import collections
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+
+class RotatingFile:
+    """Файл журнала, который при превышении max_bytes сдвигается в path.1, path.2, ..."""
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.f = open(path, 'a', encoding='utf8')
+
+    def write(self, line):
+        self.f.write(line + '\n')
+        if self.max_bytes and self.f.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        self.f = open(self.path, 'w', encoding='utf8')
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class ServerLog:
+    """Журнал сервера. Вызывающий поток только кладёт строку в ограниченную очередь,
+    вывод на терминал и в файл делает фоновый поток. Скрытый вывод хранится в кольцевом
+    буфере, частые строки (по одной на сообщение) ограничиваются по числу в секунду"""
+
+    def __init__(self, level=INFO, rate=100, path=None, file_bytes=10 * 1024 * 1024, file_count=3,
+                 queue_size=10000, hidden_size=1000):
+        self.level = level
+        self.show = True
+        self.hidden = collections.deque(maxlen=hidden_size)
+        self.file = RotatingFile(path, file_bytes, file_count) if path else None
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0     # Не поместились в очередь
+        self.suppressed = 0  # Отброшены ограничением частоты
+        # Ограничение частоты: корзина на rate строк, пополняется rate раз в секунду
+        self.rate = rate
+        self.tokens = rate
+        self.refilled = time.monotonic()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def _allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+            return True
+
+    def log(self, text, level=INFO, must_show=False, limited=False):
+        if level < self.level and not must_show:
+            return
+        if limited and self.rate and not self._allow():
+            return
+        try:
+            self.queue.put_nowait((self._write, (time.time(), text, must_show)))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, created, text, must_show):
+        if self.dropped or self.suppressed:
+            dropped, suppressed = self.dropped, self.suppressed
+            self.dropped = self.suppressed = 0
+            self._write(created, f'{dropped + suppressed} log lines skipped '
+                                 f'({dropped} queue full, {suppressed} rate limit)', False)
+        line = f'{datetime.fromtimestamp(created).strftime("%H:%M:%S")}    {text}'
+        if self.file is not None:
+            self.file.write(line)
+        if must_show or self.show:
+            print(line)
+        else:
+            self.hidden.append(line)
+
+    def _call(self, method, *args):
+        # Служебные действия идут через ту же очередь, чтобы не перемешаться с выводом
+        self.queue.put((method, args))
+
+    def toggle(self):
+        """Команда log: скрыть вывод или показать его вместе с накопленным за время скрытия"""
+        self._call(self._toggle)
+
+    def _toggle(self):
+        self.show = not self.show
+        if self.show:
+            for line in self.hidden:
+                print(line)
+            self.hidden.clear()
+
+    def run(self):
+        while True:
+            method, args = self.queue.get()
+            if method is None:
+                break
+            method(*args)
+            if self.queue.empty():
+                sys.stdout.flush()
+                if self.file is not None:
+                    self.file.flush()
+        if self.file is not None:
+            self.file.close()
+
+    def close(self, timeout=1.0):
+        """Дописывает очередь и останавливает поток"""
+        try:
+            self.queue.put((None, ()), timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
@@ -0,0 +1,372 @@
+import collections
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows: кластера без SO_REUSEPORT нет, хватает множества resuming
+    fcntl = None
+
+from message import *
+
+PARTIAL_LIFETIME = 24 * 3600  # Сколько секунд хранится недокачанная загрузка
+
+
+class HistoryStore:
+    """Журнал рассылок в SQLite. Записи только добавляются, порядковый номер seq
+    служит курсором для постраничного чтения старых сообщений"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # WAL без fsync на каждую запись: при сбое питания теряются лишь последние сообщения
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS messages (
+                               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                               time REAL NOT NULL,
+                               msg_type INTEGER NOT NULL,
+                               data BLOB NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS messages_time ON messages (time)')
+        self.db.commit()
+
+    def append(self, frame):
+        """Сохраняет кадр и возвращает его номер"""
+        with self.lock:
+            cursor = self.db.execute('INSERT INTO messages (time, msg_type, data) VALUES (?, ?, ?)',
+                                     (time.time(), frame.msg_type.value, frame.data))
+            self.db.commit()
+            return cursor.lastrowid
+
+    def page(self, before=None, limit=100, max_bytes=1024 * 1024):
+        """Не более limit сообщений с номером меньше before, от старых к новым: [(seq, Frame)]"""
+        if before is None:
+            before = 1 << 62
+        with self.lock:
+            rows = self.db.execute('SELECT seq, msg_type, data FROM messages WHERE seq < ? '
+                                   'ORDER BY seq DESC LIMIT ?', (before, limit)).fetchall()
+        page = []
+        size = 0
+        for seq, msg_type, data in rows:
+            size += len(data)
+            if page and size > max_bytes:
+                break
+            page.append((seq, Frame(data, MsgType(msg_type))))
+        page.reverse()
+        return page
+
+    def seq_at(self, timestamp):
+        """Номер первого сообщения не раньше timestamp, None если таких нет"""
+        with self.lock:
+            row = self.db.execute('SELECT MIN(seq) FROM messages WHERE time >= ?', (timestamp,)).fetchone()
+        return row[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class Upload:
+    """Принимаемый файл: пишется во временный файл, SHA-256 и crc32 считаются по ходу записи.
+    С path продолжает ранее начатый файл, key — заявленный клиентом хеш докачиваемой загрузки"""
+
+    def __init__(self, directory, path=None, key=None):
+        self.key = key
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.crc = 0
+        self.lock_fd = None
+        if path is None:
+            fd, self.path = tempfile.mkstemp(dir=directory, prefix='upload-')
+            self.f = os.fdopen(fd, 'wb')
+            return
+        self.path = path
+        self.f = open(path, 'a+b')
+        try:
+            self.lock()
+        except OSError:
+            self.f.close()
+            raise
+        self.f.seek(0)
+        chunk = self.f.read(FILE_CHUNK_SIZE)
+        while chunk:
+            self.hash.update(chunk)
+            self.crc = zlib.crc32(chunk, self.crc)
+            self.size += len(chunk)
+            chunk = self.f.read(FILE_CHUNK_SIZE)
+
+    def lock(self):
+        """Запирает докачиваемый файл: его могут открыть сразу несколько рабочих процессов кластера.
+        BlockingIOError, если файл занят или уже перенесён в хранилище. Замок держит копия
+        дескриптора, поэтому он переживает закрытие файла и снимается в unlock"""
+        if fcntl is None:
+            return
+        fd = os.dup(self.f.fileno())
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            try:
+                moved = not os.path.samestat(os.stat(self.path), os.fstat(fd))
+            except FileNotFoundError:
+                moved = True
+            if moved:
+                # Пока файл открывался, владелец замка перенёс или удалил его
+                raise BlockingIOError(f'{self.path} was moved')
+        except OSError:
+            os.close(fd)
+            raise
+        self.lock_fd = fd
+
+    def unlock(self):
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def restart(self):
+        self.f.truncate(0)
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.crc = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def format_entry(entry):
+    """Строка команды files"""
+    fileid, name, size, uploader, created, digest = entry
+    return (f'{fileid}: {name} ({size} bytes, {uploader}, '
+            f'{time.strftime("%Y-%m-%d %H:%M", time.localtime(created))}, {digest[:12]})')
+
+
+class FileStore:
+    """Загруженные файлы, сложенные по SHA-256 содержимого: одинаковые загрузки занимают место
+    на диске один раз. Видимые пользователям id и имена ссылаются на общий blob,
+    который удаляется вместе с последней ссылкой. Список файлов хранится в SQLite-индексе
+    рядом с blob и при запуске читается одним запросом, без обхода каталога"""
+
+    def __init__(self, directory='./files'):
+        self.directory = directory
+        self.tmp_directory = os.path.join(directory, 'tmp')
+        os.makedirs(self.tmp_directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.files = {}                     # id -> (имя, хеш)
+        self.refs = collections.Counter()   # хеш -> число id
+        self.checksums = {}                 # хеш -> (размер, crc32) для file_end
+        self.resuming = set()               # хеши докачиваемых сейчас загрузок
+        self.db = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        # AUTOINCREMENT помнит наибольший выданный id, поэтому id удалённых файлов не повторяются
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               name TEXT NOT NULL,
+                               digest TEXT NOT NULL,
+                               size INTEGER NOT NULL,
+                               crc INTEGER,
+                               uploader TEXT NOT NULL,
+                               time REAL NOT NULL)''')
+        self.db.commit()
+        self.count = self.load()
+        self.clean_tmp()
+
+    def load(self):
+        """Читает индекс и возвращает первый свободный номер файла"""
+        rows = self.db.execute('SELECT id, name, digest, size, crc FROM files ORDER BY id')
+        for fileid, name, digest, size, crc in rows:
+            self.files[str(fileid)] = (name, digest)
+            self.refs[digest] += 1
+            if crc is not None:
+                self.checksums[digest] = (size, crc)
+        row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'files'").fetchone()
+        return row[0] + 1 if row else 0
+
+    def new_id(self):
+        with self.lock:
+            fileid = str(self.count)
+            self.count += 1
+        return fileid
+
+    def __len__(self):
+        return len(self.files)
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def blob_size(self, digest):
+        try:
+            return os.path.getsize(self.blob_path(digest))
+        except OSError:
+            return 0
+
+    def upload(self):
+        return Upload(self.tmp_directory)
+
+    def resume(self, digest, size):
+        """Загрузка файла с известными хешем и размером: (Upload, смещение, с которого слать).
+        Принятое до обрыва хранится в tmp/partial-<хеш>. Upload None, если такой blob уже есть"""
+        with self.lock:
+            if os.path.exists(self.blob_path(digest)):
+                return None, size
+            if digest in self.resuming:
+                # Тот же файл сейчас принимается в другом соединении, его временный файл занят
+                return Upload(self.tmp_directory), 0
+            self.resuming.add(digest)
+        try:
+            upload = Upload(self.tmp_directory, os.path.join(self.tmp_directory, 'partial-' + digest), digest)
+        except BlockingIOError:
+            # Файл докачивается в другом рабочем процессе
+            self._release(digest)
+            return Upload(self.tmp_directory), 0
+        except OSError:
+            self._release(digest)
+            raise
+        if upload.size > size:
+            upload.restart()
+        return upload, upload.size
+
+    def suspend(self, upload):
+        """Соединение оборвалось: принятое остаётся на диске до следующей попытки"""
+        upload.close()
+        upload.unlock()
+        self._release(upload.key)
+
+    def _release(self, key):
+        with self.lock:
+            self.resuming.discard(key)
+
+    def clean_tmp(self):
+        # Временные файлы, брошенные упавшим процессом или так и не докачанные
+        expired = time.time() - PARTIAL_LIFETIME
+        for name in os.listdir(self.tmp_directory):
+            path = os.path.join(self.tmp_directory, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def link(self, digest, fileid, name, uploader):
+        """Новый id для уже хранящегося содержимого; False, если blob успели удалить"""
+        with self.lock:
+            if not os.path.exists(self.blob_path(digest)):
+                return False
+            self._add(fileid, name, digest, uploader)
+        return True
+
+    def commit(self, upload, fileid=None, name=None, uploader=None, store=None):
+        """Переносит принятый файл в хранилище и возвращает (хеш, был ли уже такой blob).
+        С fileid файл сразу добавляется, чтобы одновременный rm не удалил общий blob.
+        В кластере blob удаляет главный процесс, поэтому и перенос делает он: store(путь, хеш, (размер, crc32))"""
+        upload.close()
+        digest = upload.hash.hexdigest()
+        checksum = (upload.size, upload.crc)
+        try:
+            if store is None:
+                duplicate = self.store(upload.path, digest, checksum, fileid, name, uploader)
+            else:
+                duplicate = store(upload.path, digest, checksum)
+                with self.lock:
+                    self.checksums.setdefault(digest, checksum)
+        finally:
+            # Замок снимается, только когда файла уже нет на старом месте
+            upload.unlock()
+            self._release(upload.key)
+        return digest, duplicate
+
+    def store(self, path, digest, checksum, fileid=None, name=None, uploader=None):
+        """Переносит временный файл path в blob и возвращает, был ли уже такой blob"""
+        blob = self.blob_path(digest)
+        with self.lock:
+            duplicate = os.path.exists(blob)
+            if duplicate:
+                # Существующий blob остаётся на месте вместе со своими страницами в кэше
+                os.remove(path)
+            else:
+                os.replace(path, blob)
+            self.checksums[digest] = tuple(checksum)
+            if fileid is not None:
+                self._add(fileid, name, digest, uploader)
+        return duplicate
+
+    def discard(self, upload):
+        upload.close()
+        if os.path.exists(upload.path):
+            os.remove(upload.path)
+        upload.unlock()
+        self._release(upload.key)
+
+    def add(self, fileid, name, digest):
+        """Файл, добавленный другим процессом кластера, появляется в списке; индекс пишет главный процесс"""
+        with self.lock:
+            self._add(fileid, name, digest, None)
+
+    def _add(self, fileid, name, digest, uploader):
+        self.files[fileid] = (name, digest)
+        self.refs[digest] += 1
+        if uploader is None:
+            return
+        size, crc = self.checksums.get(digest) or (self.blob_size(digest), None)
+        self.db.execute('INSERT INTO files (id, name, digest, size, crc, uploader, time) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (int(fileid), name, digest, size, crc, uploader, time.time()))
+        self.db.commit()
+
+    def remove(self, fileid, unlink=True):
+        """Возвращает имя удалённого файла или None. Без unlink blob и запись индекса остаются:
+        в кластере файлы удаляет только главный процесс"""
+        with self.lock:
+            entry = self.files.pop(fileid, None)
+            if entry is None:
+                return None
+            name, digest = entry
+            if unlink:
+                self.db.execute('DELETE FROM files WHERE id = ?', (int(fileid),))
+                self.db.commit()
+            self.refs[digest] -= 1
+            if not self.refs[digest]:
+                del self.refs[digest]
+                self.checksums.pop(digest, None)
+                if unlink and os.path.exists(self.blob_path(digest)):
+                    os.remove(self.blob_path(digest))
+        return name
+
+    def open(self, fileid):
+        """Возвращает (открытый файл, хеш); KeyError, если id нет"""
+        name, digest = self.files[fileid]
+        return open(self.blob_path(digest), 'rb'), digest
+
+    def checksum(self, digest, f):
+        """Размер и crc32 для file_end; для файлов, принятых другим процессом, считаются при первой отдаче"""
+        checksum = self.checksums.get(digest)
+        if checksum is None:
+            checksum = self.checksums[digest] = file_checksum(f)
+        return checksum
+
+    def items(self):
+        """[(id, имя)] в порядке добавления"""
+        return [(fileid, name) for fileid, (name, _) in list(self.files.items())]
+
+    def entries(self):
+        """Записи индекса для администратора: [(id, имя, размер, кто загрузил, время, хеш)]"""
+        with self.lock:
+            return self.db.execute('SELECT id, name, size, uploader, time, digest FROM files ORDER BY id').fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
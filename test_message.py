@@ -0,0 +1,115 @@
+import asyncio
+import os
+import socket
+import threading
+import unittest
+import zlib
+
+from message import *
+
+
+class OversizedStreamFrameTest(unittest.TestCase):
+    """Отклонённый кадр zstream не должен сбивать распаковку следующих кадров"""
+
+    def frames(self):
+        compressor = StreamCompressor()
+        text = os.urandom(100 * 1024).hex()
+        return text, [compressor.build_frame(text.encode(), MsgType.chatmsg),
+                      compressor.build_frame(text[-300:].encode(), MsgType.chatmsg)]
+
+    def test_frame_reader(self):
+        text, frames = self.frames()
+        a, b = socket.socketpair()
+        with a, b:
+            threading.Thread(target=a.sendall, args=(b''.join(frames),), daemon=True).start()
+            reader = FrameReader(b)
+            reader.stream = StreamDecompressor()
+            with self.assertRaises(FrameTooLarge):
+                reader.read_frame()
+            self.assertEqual(reader.read_frame(), (MsgType.chatmsg, text[-300:].encode()))
+
+    def test_async_read_frame(self):
+        text, frames = self.frames()
+
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b''.join(frames))
+            stream = StreamDecompressor()
+            with self.assertRaises(FrameTooLarge):
+                await read_frame(reader, stream=stream)
+            return await read_frame(reader, stream=stream)
+
+        self.assertEqual(asyncio.run(run()), (MsgType.chatmsg, text[-300:].encode()))
+
+
+class CodecNegotiationTest(unittest.TestCase):
+    """Собеседник без FEATURE_CODECS получает кадры в старом формате: zlib без кодека в заголовке"""
+
+    def receive(self, sock):
+        length, code = HEADER.unpack(recv_exactly(sock, HEADER.size))
+        return code, bytes(recv_exactly(sock, length))
+
+    def test_zlib_until_negotiated(self):
+        a, b = socket.socketpair()
+        with a, b:
+            writer = FrameWriter(a)
+            writer.send_message('0')
+            writer.send_frame(Frame.from_message('x' * 1000, MsgType.special))
+            code, body = self.receive(b)
+            self.assertEqual((code, zlib.decompress(body)), (MsgType.none.value, b'0'))
+            code, body = self.receive(b)
+            self.assertEqual((code, zlib.decompress(body)), (MsgType.special.value, b'x' * 1000))
+
+            writer.set_features({FEATURE_CODECS})
+            writer.send_message('0')
+            self.assertEqual(self.receive(b), (MsgType.none.value | Codec.raw << CODEC_SHIFT, b'0'))
+
+
+class QueuedFeaturesTest(unittest.TestCase):
+    """Согласованные возможности видны обработчику сразу, а кодек меняется после уже поставленных кадров"""
+
+    def test_features_before_queue(self):
+        a, b = socket.socketpair()
+        with a, b:
+            writer = QueuedFrameWriter(a)
+            # Писатель занят отправкой, которую никто не читает
+            writer.send_byte_message(os.urandom(1024 * 1024), MsgType.special)
+            writer.send_message('before')
+            writer.set_features({FEATURE_CODECS, FEATURE_RESUME})
+            self.assertIn(FEATURE_RESUME, writer.features)
+            writer.send_message('after')
+
+            b.settimeout(5)
+            receive = CodecNegotiationTest.receive
+            receive(self, b)
+            self.assertEqual(receive(self, b), (MsgType.none.value, zlib.compress(b'before')))
+            self.assertEqual(receive(self, b), (MsgType.none.value | Codec.raw << CODEC_SHIFT, b'after'))
+
+
+class QueuedReplyTest(unittest.TestCase):
+    """При drop_oldest из переполненной очереди выбрасываются рассылки, но не ответ на запрос"""
+
+    def test_reply_is_not_dropped(self):
+        a, b = socket.socketpair()
+        with a, b:
+            writer = QueuedFrameWriter(a, max_bytes=256 * 1024, overflow=OVERFLOW_DROP_OLDEST)
+            writer.set_features({FEATURE_CODECS, FEATURE_FIELDS})
+            flood = [Frame(os.urandom(32 * 1024), MsgType.chatmsg) for _ in range(64)]
+            for frame in flood:
+                writer.send_frame(frame)
+            writer.send_reply(Frame(b'files', MsgType.get_file))
+            for frame in flood:
+                writer.send_frame(frame)
+            writer.send_frame(Frame(b'after', MsgType.chatmsg))
+
+            b.settimeout(5)
+            reader = FrameReader(b)
+            received = []
+            while not received or received[-1] != (MsgType.chatmsg, b'after'):
+                received.append(reader.read_frame())
+            self.assertIn((MsgType.get_file, b'files'), received)
+            self.assertLess(len(received), 2 * len(flood))
+
+
+if __name__ == '__main__':
+    unittest.main()
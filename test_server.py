@@ -0,0 +1,143 @@
+import contextlib
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+from message import *
+from server import ChatServer
+
+
+def wait(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+class ServerTestCase(unittest.TestCase):
+    """Сервер в режиме потоков во временном каталоге, без консоли и истории на диске"""
+
+    server_options = {}
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        self.server = ChatServer(host='127.0.0.1', port=0, history_db='', **self.server_options)
+        self.server.console = False
+        self.server.logger.log = lambda *args, **kwargs: None
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.port = self.server.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.file_store.close()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def connect(self):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.settimeout(5)
+        self.addCleanup(sock.close)
+        return sock
+
+    def login(self, name):
+        sock = self.connect()
+        send_message(sock, name)
+        reader = FrameReader(sock)
+        self.assertEqual(reader.receive_message(), (MsgType.none, '0'))
+        return sock, reader
+
+    def read_until(self, reader, msg_type):
+        while True:
+            frame = reader.read_frame()
+            if frame is None or frame[0] == msg_type:
+                return frame
+
+
+class MalformedLoginTest(ServerTestCase):
+    def test_connection_released(self):
+        threads = threading.active_count()
+        for _ in range(20):
+            sock = self.connect()
+            send_byte_message(sock, b'\xff\xfe', MsgType.none)
+            # Сервер закрывает соединение, а не оставляет поток-писатель висеть
+            self.assertEqual(sock.recv(1), b'')
+        self.assertTrue(wait(lambda: threading.active_count() <= threads + 1))
+
+
+class InboundLimitTest(ServerTestCase):
+    def test_request_limit(self):
+        sock, reader = self.login('alice')
+        # Запрос списка пользователей пуст, мегабайт в нём сервер не читает в память
+        send_byte_message(sock, b'x' * 1024 * 1024, MsgType.usersinfo, compress=False)
+        self.assertEqual(self.read_until(reader, MsgType.error),
+                         (MsgType.error, b'Message of type usersinfo is too large'))
+        send_byte_message(sock, b'', MsgType.usersinfo)
+        self.assertIsNotNone(self.read_until(reader, MsgType.usersinfo))
+
+    def test_server_only_type(self):
+        sock, reader = self.login('alice')
+        send_byte_message(sock, b'', MsgType.srv_shutdown)
+        self.assertIsNone(self.read_until(reader, MsgType.error))
+        self.assertTrue(wait(lambda: not len(self.server.users)))
+
+
+class UploadRequestTest(ServerTestCase):
+    def test_malformed_request(self):
+        sock = self.connect()
+        reader = FrameReader(sock)
+        send_message(sock, f'{FEATURE_CODECS} {FEATURE_FIELDS} {FEATURE_RESUME}', MsgType.hello)
+        self.assertEqual(reader.receive_message(), (MsgType.hello, f'{FEATURE_CODECS} {FEATURE_FIELDS} {FEATURE_RESUME}'))
+        send_message(sock, 'alice')
+        self.assertEqual(reader.receive_message(), (MsgType.none, '0'))
+        for request in ('a.txt', f'{"0" * 64} many a.txt', f'{"x" * 64} 10 a.txt'):
+            send_message(sock, request, MsgType.put_file)
+            self.assertEqual(self.read_until(reader, MsgType.error),
+                             (MsgType.error, b'Your file was not saved'))
+        # Соединение не разорвано
+        send_byte_message(sock, b'', MsgType.usersinfo)
+        self.assertIsNotNone(self.read_until(reader, MsgType.usersinfo))
+
+
+class UsersCommandTest(ServerTestCase):
+    def test_send_latency(self):
+        sock, reader = self.login('alice')
+        self.server.broadcast(encode_fields('admin', 'hi'), inbytes=True)
+        self.read_until(reader, MsgType.chatmsg)
+        user = self.server.users.get_by_name('alice')
+        self.assertTrue(wait(lambda: user.writer.latency_count))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.server.print_users()
+        self.assertIn('alice', output.getvalue())
+        self.assertIn('send latency avg', output.getvalue())
+
+
+class LegacyClientTest(ServerTestCase):
+    """Клиент без hello получает кадры zlib и поля через NUL, как от исходного сервера"""
+
+    def receive(self, sock):
+        length, code = HEADER.unpack(sock.recv(HEADER.size, socket.MSG_WAITALL))
+        return MsgType(code), zlib.decompress(sock.recv(length, socket.MSG_WAITALL))
+
+    def test_chat_and_users(self):
+        sock = self.connect()
+        send_message(sock, 'old')
+        self.assertEqual(self.receive(sock), (MsgType.none, b'0'))
+        self.server.broadcast(encode_fields('admin', 'hi'), inbytes=True)
+        while (frame := self.receive(sock))[0] != MsgType.chatmsg:
+            pass
+        self.assertEqual(frame, (MsgType.chatmsg, b'admin\0hi'))
+        send_message(sock, '', MsgType.usersinfo)
+        self.assertEqual(self.receive(sock), (MsgType.usersinfo, b'old'))
+
+
+if __name__ == '__main__':
+    unittest.main()
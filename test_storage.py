@@ -0,0 +1,89 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from storage import FileStore
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def open_store(self):
+        store = FileStore(self.directory.name)
+        self.addCleanup(store.close)
+        return store
+
+    def blobs(self):
+        return [name for name in os.listdir(self.directory.name) if len(name) == 64]
+
+    def put(self, store, data, fileid, name):
+        upload = store.upload()
+        upload.write(data)
+        return store.commit(upload, fileid, name, 'alice')
+
+
+class DedupTest(StoreTestCase):
+    """Одинаковое содержимое хранится одним blob, который живёт до удаления последней ссылки"""
+
+    def test_shared_blob(self):
+        store = self.open_store()
+        digest, duplicate = self.put(store, b'data', '0', 'a.txt')
+        self.assertFalse(duplicate)
+        self.assertEqual(self.put(store, b'data', '1', 'b.txt'), (digest, True))
+        self.assertEqual(self.blobs(), [digest])
+        self.assertEqual(os.listdir(store.tmp_directory), [])
+
+        self.assertEqual(store.remove('0'), 'a.txt')
+        self.assertEqual(self.blobs(), [digest])
+        with store.open('1')[0] as f:
+            self.assertEqual(f.read(), b'data')
+
+        self.assertEqual(store.remove('1'), 'b.txt')
+        self.assertEqual(self.blobs(), [])
+        # Ссылка на удалённое содержимое не создаётся
+        self.assertFalse(store.link(digest, '2', 'c.txt', 'alice'))
+        self.assertEqual(store.items(), [])
+
+    def test_index_reloaded(self):
+        store = self.open_store()
+        digest, _ = self.put(store, b'data', store.new_id(), 'a.txt')
+        self.put(store, b'data', store.new_id(), 'b.txt')
+        store.remove('0')
+        store.close()
+        store = self.open_store()
+        self.assertEqual(store.items(), [('1', 'b.txt')])
+        self.assertEqual(store.new_id(), '2')
+        self.assertEqual(store.refs[digest], 1)
+
+
+class ResumeLockTest(StoreTestCase):
+    """Два процесса кластера с общим каталогом не дописывают один и тот же частичный файл"""
+
+    def test_busy_partial(self):
+        data = b'x' * 1000
+        digest = hashlib.sha256(data).hexdigest()
+        first, second = self.open_store(), self.open_store()
+
+        upload, offset = first.resume(digest, len(data))
+        self.assertEqual(offset, 0)
+        upload.write(data[:400])
+        first.suspend(upload)
+
+        upload, offset = first.resume(digest, len(data))
+        self.assertEqual(offset, 400)
+        # Частичный файл занят первым процессом: второй принимает файл заново
+        other, other_offset = second.resume(digest, len(data))
+        self.assertEqual(other_offset, 0)
+        self.assertNotEqual(other.path, upload.path)
+        second.discard(other)
+
+        upload.write(data[400:])
+        self.assertEqual(first.commit(upload, '0', 'a.txt', 'alice'), (digest, False))
+        self.assertEqual(second.resume(digest, len(data)), (None, len(data)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,5 @@
 import curses
-from base_client import BaseChatClient
+from base_client import BaseChatClient, parse_client_args
 
 class TUIChatClient(BaseChatClient):
     def __init__(self, host='localhost', port=5555):
@@ -151,5 +151,6 @@ class TUIChatClient(BaseChatClient):
         return input_str
 
 if __name__ == "__main__":
-    client = TUIChatClient()
+    args = parse_client_args('Curses chat client')
+    client = TUIChatClient(args.host, args.port)
     client.start()